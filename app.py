@@ -4,8 +4,19 @@ import base64
 import os
 import boto3
 import json
+import time
 from dotenv import load_dotenv
 
+# Measures how long each script run (first load and reruns) takes
+RUN_STARTED = time.perf_counter()
+
+# The backend answers 429 + Retry-After when recognition capacity is exhausted
+MAX_BUSY_RETRIES = 2
+MAX_BUSY_WAIT_SECONDS = 5
+# Two-phase registration: how long to wait for the uploaded photo to be processed
+REGISTRATION_POLL_SECONDS = 1
+REGISTRATION_TIMEOUT_SECONDS = 30
+
 
 # Configure page
 st.set_page_config(
@@ -14,47 +25,130 @@ st.set_page_config(
     layout="centered"
 )
 
-# Load environment variables
-load_dotenv()
-
-# -------------------------------------------
-# Esto toma los secretos de Streamlit Cloud y se los da a Boto3
-try:
-    # Al acceder a st.secrets, Streamlit intenta leer el archivo.
-    # Si falla (FileNotFoundError), saltamos al bloque 'except'.
-    if hasattr(st, "secrets"):
-        # Mapeo de Credenciales AWS
-        if "AWS_ACCESS_KEY_ID" in st.secrets:
-            os.environ["AWS_ACCESS_KEY_ID"] = st.secrets["AWS_ACCESS_KEY_ID"]
-        if "AWS_SECRET_ACCESS_KEY" in st.secrets:
-            os.environ["AWS_SECRET_ACCESS_KEY"] = st.secrets["AWS_SECRET_ACCESS_KEY"]
-        if "AWS_DEFAULT_REGION" in st.secrets:
-            os.environ["AWS_DEFAULT_REGION"] = st.secrets["AWS_DEFAULT_REGION"]
-        
-        # Mapeo de la URL del API
-        if "API_GATEWAY_URL" in st.secrets:
-            os.environ["API_GATEWAY_URL"] = st.secrets["API_GATEWAY_URL"]
-
-except FileNotFoundError:
-    # Estamos en local y no existe .streamlit/secrets.toml
-    # Ignoramos el error porque confiamos en que load_dotenv() ya hizo el trabajo.
-    pass
-except Exception:
-    # Cualquier otro error de configuración lo ignoramos para no romper la app
-    pass
-# -------------------------------------------
+# Streamlit reruns the whole script on every interaction. Older releases
+# (Python 3.7) lack the caching/fragment APIs, so fall back to their predecessors.
+cache_resource = getattr(st, "cache_resource", None) or st.experimental_singleton
+cache_data = getattr(st, "cache_data", None) or st.experimental_memo
+fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda f: f)
+
+# CloudWatch widget images are reused for this long unless "Refresh Metrics" is pressed
+DASHBOARD_CACHE_SECONDS = 300
+
+# Dashboard widgets
+# Widget 1: Access Attempts
+WIDGET_ACCESS = {
+    "view": "timeSeries",
+    "stacked": False,
+    "metrics": [
+        [ "BiometricAccessControl", "AccessAttempts", "Status", "Granted", { "stat": "Sum", "period": 3600, "label": "Granted" } ],
+        [ "...", "Denied", { "stat": "Sum", "period": 3600, "label": "Denied" } ]
+    ],
+    "width": 600,
+    "height": 400,
+    "start": "-PT24H",
+    "end": "P0D",
+    "title": "Access Attempts (Last 24 Hours)"
+}
+
+# Widget 2: Registrations
+WIDGET_REGISTRATIONS = {
+    "view": "singleValue",
+    "metrics": [
+        [ "BiometricAccessControl", "EmployeeRegistrations", { "stat": "Sum", "period": 86400, "label": "Total Registrations" } ]
+    ],
+    "width": 600,
+    "height": 200,
+    "start": "-P7D",
+    "end": "P0D",
+    "title": "Registrations (Last 7 Days)"
+}
+
+
+@cache_resource
+def load_config():
+    """Loads .env and the Streamlit secrets into os.environ, once per process. Returns the time it took."""
+    started = time.perf_counter()
+
+    # Load environment variables
+    load_dotenv()
+
+    # -------------------------------------------
+    # Esto toma los secretos de Streamlit Cloud y se los da a Boto3
+    try:
+        # Al acceder a st.secrets, Streamlit intenta leer el archivo.
+        # Si falla (FileNotFoundError), saltamos al bloque 'except'.
+        if hasattr(st, "secrets"):
+            # Mapeo de Credenciales AWS
+            if "AWS_ACCESS_KEY_ID" in st.secrets:
+                os.environ["AWS_ACCESS_KEY_ID"] = st.secrets["AWS_ACCESS_KEY_ID"]
+            if "AWS_SECRET_ACCESS_KEY" in st.secrets:
+                os.environ["AWS_SECRET_ACCESS_KEY"] = st.secrets["AWS_SECRET_ACCESS_KEY"]
+            if "AWS_DEFAULT_REGION" in st.secrets:
+                os.environ["AWS_DEFAULT_REGION"] = st.secrets["AWS_DEFAULT_REGION"]
+
+            # Mapeo de la URL del API
+            if "API_GATEWAY_URL" in st.secrets:
+                os.environ["API_GATEWAY_URL"] = st.secrets["API_GATEWAY_URL"]
+
+    except FileNotFoundError:
+        # Estamos en local y no existe .streamlit/secrets.toml
+        # Ignoramos el error porque confiamos en que load_dotenv() ya hizo el trabajo.
+        pass
+    except Exception:
+        # Cualquier otro error de configuración lo ignoramos para no romper la app
+        pass
+    # -------------------------------------------
+
+    return time.perf_counter() - started
+
+load_config()
+
+def get_http_session():
+    """
+    HTTP session of the current browser session: keeps the TLS connection to API
+    Gateway alive between requests. requests.Session is not guaranteed to be
+    thread-safe, so it is never shared between browser sessions.
+    """
+    if "http_session" not in st.session_state:
+        st.session_state["http_session"] = requests.Session()
+    return st.session_state["http_session"]
+
+@cache_resource
+def get_cloudwatch_client():
+    """CloudWatch client, created once per process (after load_config has set the credentials)."""
+    return boto3.client('cloudwatch')
 
 
 
 def get_base_url(api_url):
-    """Cleans the API URL to get the base endpoint (without /access or /register)."""
+    """Cleans the API URL to get the base endpoint (without /access, /register or /employees)."""
     api_url = api_url.rstrip('/')
     if api_url.endswith('/access'):
         return api_url[:-7]
     if api_url.endswith('/register'):
         return api_url[:-9]
+    if api_url.endswith('/employees'):
+        return api_url[:-10]
     return api_url
 
+def post_with_retry(url, **kwargs):
+    """POSTs to the API, waiting Retry-After seconds and retrying while it answers 429."""
+    for attempt in range(MAX_BUSY_RETRIES + 1):
+        response = get_http_session().post(url, **kwargs)
+        if response.status_code != 429 or attempt == MAX_BUSY_RETRIES:
+            return response
+        try:
+            retry_after = int(response.headers.get('Retry-After', '1'))
+        except ValueError:
+            retry_after = 1
+        retry_after = min(max(retry_after, 1), MAX_BUSY_WAIT_SECONDS)
+        print(f"Server busy, retrying in {retry_after}s (attempt {attempt + 1}/{MAX_BUSY_RETRIES})")
+        time.sleep(retry_after)
+
+def show_busy(retry_after):
+    """Shows the 'system busy' message of a 429 response."""
+    st.warning(f"⏳ System busy. Please try again in {retry_after} seconds.")
+
 def verify_access(api_url, image_bytes):
     """Sends the image to the API Gateway for verification."""
     base_url = get_base_url(api_url)
@@ -68,7 +162,7 @@ def verify_access(api_url, image_bytes):
         print(f"Sending verification request to: {verify_url}")
 
         with st.spinner('Verifying identity...'):
-            response = requests.post(verify_url, headers=headers, data=encoded_string)
+            response = post_with_retry(verify_url, headers=headers, data=encoded_string)
 
         print(f"Received status code: {response.status_code}")
         return response
@@ -82,15 +176,41 @@ def verify_access(api_url, image_bytes):
         st.error(f"An error occurred: {str(e)}")
         return None
 
+def parse_json(response):
+    """Returns the JSON body of a response, or its text as a message."""
+    try:
+        return response.json()
+    except ValueError:
+        return {"message": response.text}
+
+def wait_for_registration(base_url, registration_id):
+    """Polls GET /register/{registrationId} until the registration finishes. Returns (status_code, data)."""
+    status_url = f"{base_url}/register/{registration_id}"
+    deadline = time.monotonic() + REGISTRATION_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        response = get_http_session().get(status_url, timeout=10)
+        data = parse_json(response)
+        if response.status_code != 200:
+            return response.status_code, data
+        if data.get('status') == 'COMPLETED':
+            return 200, data
+        if data.get('status') == 'FAILED':
+            return data.get('errorCode', 500), data
+        time.sleep(REGISTRATION_POLL_SECONDS)
+    return 504, {"message": "Registration is still being processed, check again later.",
+                 "registrationId": registration_id}
+
 def register_employee(api_url, image_bytes, first_name, last_name, cedula, city):
-    """Sends employee data to the API Gateway for registration."""
+    """
+    Registers an employee in two phases: sends the employee data, uploads the
+    photo straight to S3 with the returned presigned URL and waits for the
+    result. Returns (status_code, response_data), or None on connection errors.
+    """
     base_url = get_base_url(api_url)
     register_url = f"{base_url}/register"
 
     try:
-        encoded_image = base64.b64encode(image_bytes).decode('utf-8')
         payload = {
-            "image": encoded_image,
             "firstName": first_name,
             "lastName": last_name,
             "cedula": cedula,
@@ -101,10 +221,16 @@ def register_employee(api_url, image_bytes, first_name, last_name, cedula, city)
         print(f"Sending registration request to: {register_url}")
 
         with st.spinner('Registering employee...'):
-            response = requests.post(register_url, json=payload, headers=headers)
-
-        print(f"Received status code: {response.status_code}")
-        return response
+            response = post_with_retry(register_url, json=payload, headers=headers)
+            print(f"Received status code: {response.status_code}")
+            data = parse_json(response)
+            if response.status_code != 202:
+                return response.status_code, data
+
+            upload = get_http_session().put(data['uploadUrl'], data=image_bytes,
+                                  headers={'Content-Type': 'image/jpeg'}, timeout=30)
+            upload.raise_for_status()
+            return wait_for_registration(base_url, data['registrationId'])
     except requests.exceptions.RequestException as e:
         st.error(f"Connection Error: {str(e)}")
         return None
@@ -112,16 +238,145 @@ def register_employee(api_url, image_bytes, first_name, last_name, cedula, city)
         st.error(f"An error occurred: {str(e)}")
         return None
 
-def get_dashboard_image(metric_widget_json):
-    """Fetches a metric widget image from CloudWatch."""
+def employee_exists(api_url, cedula):
+    """Checks whether a Cedula is already registered. Returns False if not or on error."""
+    base_url = get_base_url(api_url)
+    exists_url = f"{base_url}/employees/exists"
+
+    try:
+        response = get_http_session().get(exists_url, params={"cedula": cedula}, timeout=10)
+        if response.status_code != 200:
+            print(f"Employee lookup returned status code: {response.status_code}")
+            return False
+        return bool(response.json().get("exists"))
+    except Exception as e:
+        # The lookup is only a pre-check, the backend still enforces uniqueness
+        print(f"Employee lookup failed: {e}")
+        return False
+
+@cache_data(ttl=DASHBOARD_CACHE_SECONDS, show_spinner=False)
+def fetch_dashboard_image(metric_widget_json):
+    """Fetches a metric widget image from CloudWatch (cached, errors are not)."""
+    response = get_cloudwatch_client().get_metric_widget_image(MetricWidget=metric_widget_json)
+    return response['MetricWidgetImage']
+
+def get_dashboard_image(metric_widget):
+    """Returns the image of a metric widget, or None after showing the error."""
     try:
-        cw = boto3.client('cloudwatch')
-        response = cw.get_metric_widget_image(MetricWidget=metric_widget_json)
-        return response['MetricWidgetImage']
+        return fetch_dashboard_image(json.dumps(metric_widget, sort_keys=True))
     except Exception as e:
         st.error(f"Failed to load dashboard: {str(e)}")
         return None
 
+@fragment
+def dashboard_section():
+    """Dashboard mode. Its widgets only rerun this section."""
+    st.subheader("System Monitoring")
+    st.info("Metrics are pulled directly from CloudWatch.")
+
+    col1, col2 = st.columns(2)
+
+    with col1:
+        st.markdown("#### Access Attempts")
+        img_access = get_dashboard_image(WIDGET_ACCESS)
+        if img_access:
+            st.image(img_access)
+
+    with col2:
+        st.markdown("#### Employee Registrations")
+        img_reg = get_dashboard_image(WIDGET_REGISTRATIONS)
+        if img_reg:
+            st.image(img_reg)
+
+    # Clearing the cache before the section reruns fetches fresh images
+    st.button("Refresh Metrics", on_click=fetch_dashboard_image.clear)
+
+@fragment
+def verify_section(api_url):
+    """Verify Access mode. Camera and button interactions only rerun this section."""
+    st.subheader("User Verification")
+
+    img_file_buffer = st.camera_input("Take a photo to request access", key="verify_cam")
+
+    if img_file_buffer is not None:
+        bytes_data = img_file_buffer.getvalue()
+
+        if st.button("Verify Access", type="primary", use_container_width=True):
+            response = verify_access(api_url, bytes_data)
+
+            if response is not None:
+                status_code = response.status_code
+                try:
+                    response_data = response.json()
+                except:
+                    response_data = {"message": response.text}
+
+                st.divider()
+                if status_code == 200:
+                    st.success(f"✅ Access Granted")
+                    st.json(response_data)
+                elif status_code == 403:
+                    st.error(f"⛔ Access Denied")
+                    st.warning(f"Reason: {response_data.get('message', 'Unknown')}")
+                elif status_code == 429:
+                    show_busy(response.headers.get('Retry-After', '1'))
+                else:
+                    st.warning(f"⚠️ Status: {status_code}")
+                    st.info(f"Response: {response_data}")
+            else:
+                st.error("Failed to get a response from the server.")
+
+@fragment
+def register_section(api_url):
+    """Register Employee mode. Typing in the form only reruns this section, not the whole app."""
+    st.subheader("New Employee Registration")
+
+    # REMOVED st.form wrapper to allow easier state management and interaction
+    col1, col2 = st.columns(2)
+    with col1:
+        first_name = st.text_input("First Name")
+        cedula = st.text_input("ID Document (Cedula)")
+    with col2:
+        last_name = st.text_input("Last Name")
+        city = st.selectbox("City", ["Medellin", "Bogota", "Cali", "Cartagena"])
+
+    st.markdown("#### Capture Photo")
+    reg_img_buffer = st.camera_input("Take a photo for registration", key="register_cam")
+
+    # Final Register Action
+    if st.button("Register Employee", type="primary", use_container_width=True):
+        # Validation logic
+        if not (first_name and last_name and cedula and city):
+             st.error("Please fill in all text fields (Name, Last Name, ID, City).")
+        elif reg_img_buffer is None:
+             st.error("Please take a photo.")
+        elif employee_exists(api_url, cedula):
+             st.error(f"An employee with ID (Cedula) {cedula} is already registered.")
+        else:
+            bytes_data = reg_img_buffer.getvalue()
+            result = register_employee(api_url, bytes_data, first_name, last_name, cedula, city)
+
+            if result is not None:
+                status_code, response_data = result
+
+                if status_code == 200:
+                    st.balloons()
+                    st.success("✅ Employee Registered Successfully!")
+                    st.json(response_data)
+                elif status_code == 429:
+                    show_busy(response_data.get('retryAfter', 1))
+                else:
+                    st.error(f"❌ Registration Failed (Status: {status_code})")
+                    st.json(response_data)
+
+def show_run_time():
+    """Shows how long the first load and the last full rerun of the script took."""
+    elapsed_ms = (time.perf_counter() - RUN_STARTED) * 1000
+    if "startup_ms" not in st.session_state:
+        st.session_state["startup_ms"] = elapsed_ms
+        print(f"Startup took {elapsed_ms:.0f} ms (config: {load_config() * 1000:.0f} ms)")
+    st.sidebar.caption(f"Startup: {st.session_state['startup_ms']:.0f} ms · Last rerun: {elapsed_ms:.0f} ms")
+
 def main():
     st.title("🔒 Biometric Access Control")
     st.markdown("### Identity Verification System")
@@ -144,141 +399,17 @@ def main():
         st.header("Mode")
         mode = st.radio("Select Action:", ["Verify Access", "Register Employee", "Dashboard"])
 
-    # --- DASHBOARD MODE (No API URL needed technically, but keeps flow consistent) ---
     if mode == "Dashboard":
-        st.subheader("System Monitoring")
-        st.info("Metrics are pulled directly from CloudWatch.")
-
-        # Define Widgets
-        # Widget 1: Access Attempts
-        widget_access = {
-            "view": "timeSeries",
-            "stacked": False,
-            "metrics": [
-                [ "BiometricAccessControl", "AccessAttempts", "Status", "Granted", { "stat": "Sum", "period": 3600, "label": "Granted" } ],
-                [ "...", "Denied", { "stat": "Sum", "period": 3600, "label": "Denied" } ]
-            ],
-            "width": 600,
-            "height": 400,
-            "start": "-PT24H",
-            "end": "P0D",
-            "title": "Access Attempts (Last 24 Hours)"
-        }
-
-        # Widget 2: Registrations
-        widget_registrations = {
-            "view": "singleValue",
-            "metrics": [
-                [ "BiometricAccessControl", "EmployeeRegistrations", { "stat": "Sum", "period": 86400, "label": "Total Registrations" } ]
-            ],
-            "width": 600,
-            "height": 200,
-            "start": "-P7D",
-            "end": "P0D",
-            "title": "Registrations (Last 7 Days)"
-        }
-
-        col1, col2 = st.columns(2)
-
-        with col1:
-            st.markdown("#### Access Attempts")
-            img_access = get_dashboard_image(json.dumps(widget_access))
-            if img_access:
-                st.image(img_access)
-
-        with col2:
-            st.markdown("#### Employee Registrations")
-            img_reg = get_dashboard_image(json.dumps(widget_registrations))
-            if img_reg:
-                st.image(img_reg)
-
-        if st.button("Refresh Metrics"):
-            # Handle compatibility for older Streamlit versions on Python 3.7
-            if hasattr(st, 'rerun'):
-                st.rerun()
-            else:
-                st.experimental_rerun()
-
-        return
-
+        dashboard_section()
     # Validation for other modes that need API URL
-    if not api_url:
+    elif not api_url:
         st.info("Please configure the API Gateway URL in the sidebar to proceed.")
-        return
-
-    # --- VERIFY ACCESS MODE ---
-    if mode == "Verify Access":
-        st.subheader("User Verification")
-
-        img_file_buffer = st.camera_input("Take a photo to request access", key="verify_cam")
-
-        if img_file_buffer is not None:
-            bytes_data = img_file_buffer.getvalue()
-
-            if st.button("Verify Access", type="primary", use_container_width=True):
-                response = verify_access(api_url, bytes_data)
-
-                if response is not None:
-                    status_code = response.status_code
-                    try:
-                        response_data = response.json()
-                    except:
-                        response_data = {"message": response.text}
-
-                    st.divider()
-                    if status_code == 200:
-                        st.success(f"✅ Access Granted")
-                        st.json(response_data)
-                    elif status_code == 403:
-                        st.error(f"⛔ Access Denied")
-                        st.warning(f"Reason: {response_data.get('message', 'Unknown')}")
-                    else:
-                        st.warning(f"⚠️ Status: {status_code}")
-                        st.info(f"Response: {response_data}")
-                else:
-                    st.error("Failed to get a response from the server.")
-
-    # --- REGISTER EMPLOYEE MODE ---
+    elif mode == "Verify Access":
+        verify_section(api_url)
     elif mode == "Register Employee":
-        st.subheader("New Employee Registration")
-
-        # REMOVED st.form wrapper to allow easier state management and interaction
-        col1, col2 = st.columns(2)
-        with col1:
-            first_name = st.text_input("First Name")
-            cedula = st.text_input("ID Document (Cedula)")
-        with col2:
-            last_name = st.text_input("Last Name")
-            city = st.selectbox("City", ["Medellin", "Bogota", "Cali", "Cartagena"])
-
-        st.markdown("#### Capture Photo")
-        reg_img_buffer = st.camera_input("Take a photo for registration", key="register_cam")
-
-        # Final Register Action
-        if st.button("Register Employee", type="primary", use_container_width=True):
-            # Validation logic
-            if not (first_name and last_name and cedula and city):
-                 st.error("Please fill in all text fields (Name, Last Name, ID, City).")
-            elif reg_img_buffer is None:
-                 st.error("Please take a photo.")
-            else:
-                bytes_data = reg_img_buffer.getvalue()
-                response = register_employee(api_url, bytes_data, first_name, last_name, cedula, city)
-
-                if response is not None:
-                    status_code = response.status_code
-                    try:
-                        response_data = response.json()
-                    except:
-                        response_data = {"message": response.text}
-
-                    if status_code == 200:
-                        st.balloons()
-                        st.success("✅ Employee Registered Successfully!")
-                        st.json(response_data)
-                    else:
-                        st.error(f"❌ Registration Failed (Status: {status_code})")
-                        st.json(response_data)
+        register_section(api_url)
+
+    show_run_time()
 
 if __name__ == "__main__":
     main()
@@ -46,6 +46,19 @@ def check_bucket_exists(bucketname):
             exists = False
     return exists
 
+def install_requirements(function, requirements_path):
+    '''pip install a function's requirements as Lambda (python3.9, x86_64) wheels. Returns the target directory.'''
+    target = "deps/%s" % function
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    # Binary wheels built for the Lambda runtime, not for the build machine
+    result = call(["pip", "install", "-r", requirements_path, "--target", target,
+                   "--platform", "manylinux2014_x86_64", "--implementation", "cp",
+                   "--python-version", "3.9", "--only-binary=:all:", "--upgrade"])
+    if result != 0:
+        raise Exception("Failed to install %s for %s" % (requirements_path, function))
+    return target
+
 @task()
 def clean():
     '''Clean build directory.'''
@@ -72,6 +85,12 @@ def packagelambda(* functions):
         zipf = zipfile.ZipFile("%s.zip" % function, "w", zipfile.ZIP_DEFLATED)
         
         write_dir_to_zip("../lambda/%s/" % function, zipf)
+        # Modules shared by all functions (recognition backend, ...)
+        write_dir_to_zip("../lambda/common/", zipf)
+        # Third-party packages the function needs beyond the runtime's boto3
+        requirements_path = "../lambda/%s/requirements.txt" % function
+        if os.path.exists(requirements_path):
+            write_dir_to_zip(install_requirements(function, requirements_path), zipf)
         if os.path.exists(f"../config/{function}-params.json"):
             zipf.write(f"../config/{function}-params.json", f"{function}-params.json")
 
@@ -116,6 +135,8 @@ def deploylambda(* functions, **kwargs):
     s3_keys["imageprocessor"] = cfn_params_dict.get("ImageProcessorSourceS3KeyParameter")
     s3_keys["access_control_handler"] = cfn_params_dict.get("AccessControlLambdaSourceS3KeyParameter")
     s3_keys["register_employee"] = cfn_params_dict.get("RegisterEmployeeLambdaSourceS3KeyParameter")
+    s3_keys["list_employees"] = cfn_params_dict.get("ListEmployeesLambdaSourceS3KeyParameter")
+    s3_keys["decision_worker"] = cfn_params_dict.get("DecisionWorkerLambdaSourceS3KeyParameter")
 
     s3_client = boto3.client("s3")
     
@@ -252,6 +273,24 @@ def stackstatus(global_params_path="config/global-params.json"):
         print("EXCEPTION: " + e.response["Error"]["Message"])
 
 
+@task()
+def accessreport(month=None, out_dir="build/analytics", segments="8"):
+    '''Export access logs and employees to columnar files and print the access reports.'''
+    from tools import access_analytics
+
+    start_t = time.time()
+    access_analytics.run(month=month, out_dir=out_dir, total_segments=int(segments))
+    print("Report generated in %.1f secs." % (time.time() - start_t))
+
+
+@task()
+def calibrate(dataset, collection="employees", max_far="0.001"):
+    '''Sweep FaceMatchThreshold values over a labeled image set using cached similarity scores.'''
+    from tools import calibrate_threshold
+
+    calibrate_threshold.run(dataset, collection_id=collection, max_far=float(max_far))
+
+
 @task()
 def deletestack(** kwargs):
     '''Delete Amazon Rekognition Video Analyzer infrastructure using CloudFormation.'''
@@ -2,9 +2,137 @@ import boto3
 import json
 import base64
 import os
-import uuid
-from datetime import datetime
+import re
+from concurrent.futures import ThreadPoolExecutor
+from recognition_backend import get_backend, InvalidImageError
+from admission import admitted, AdmissionRejected, PRIORITY_ACCESS
+from decision_events import new_decision_event, publish_decisions
+from frame_cache import get_frame_cache
+from profiling import profiled
 
+DEFAULT_DOOR_ID = 'default'
+MAX_BATCH_FRAMES = 8
+
+# The threshold belongs to the collection it was calibrated against
+# (see tools/calibrate_threshold.py), so both are configured together.
+COLLECTION_ID = os.environ.get('REKOGNITION_COLLECTION_ID', 'employees')
+FACE_MATCH_THRESHOLD = float(os.environ.get('FACE_MATCH_THRESHOLD', '95'))
+
+
+class MalformedBatchError(Exception):
+    """The body looks like a batch request but is not a valid one."""
+
+
+def get_door_id(event):
+    """Reads the door identifier from the X-Door-Id header or the ?door= query parameter."""
+    headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    query = event.get('queryStringParameters') or {}
+    door_id = headers.get('x-door-id') or query.get('door') or DEFAULT_DOOR_ID
+
+    # Door IDs become part of the S3 key, keep them to a safe charset
+    door_id = re.sub(r'[^a-zA-Z0-9_.\-]', '', door_id)
+    return door_id or DEFAULT_DOOR_ID
+
+
+def parse_frames(event):
+    """
+    Returns the list of frames of a batch request, or None for the classic
+    single-image request whose body is the base64 image itself.
+
+    Batch body: {"frames": [{"lane": "1", "image": "<base64>"}, ...]}
+    Raises MalformedBatchError for a JSON body that is not such a batch.
+    """
+    body = (event.get('body') or '').lstrip()
+    # '{' is not in the base64 alphabet, so a single image never looks like JSON
+    if not body.startswith('{'):
+        return None
+    try:
+        payload = json.loads(body)
+    except ValueError as e:
+        raise MalformedBatchError(f'Invalid JSON body: {e}')
+    frames = payload.get('frames')
+    if not isinstance(frames, list):
+        raise MalformedBatchError('A batch body must contain a "frames" list')
+    if not all(isinstance(frame, dict) for frame in frames):
+        raise MalformedBatchError('Every frame must be an object with "lane" and "image"')
+    return frames
+
+
+def recognize(backend, image_bytes):
+    """
+    Runs face detection and the collection search for one image.
+    Returns (outcome, face_id) with outcome one of 'no_face', 'multiple_faces',
+    'match' or 'no_match'.
+    """
+    # Step 1: Detect and count faces in the image
+    num_faces = backend.detect_faces(image_bytes)
+    if num_faces == 0:
+        return 'no_face', None
+    if num_faces > 1:
+        return 'multiple_faces', None
+
+    # Step 2: Search the collection (exactly 1 face)
+    matches = backend.search_faces(image_bytes, COLLECTION_ID, FACE_MATCH_THRESHOLD, max_faces=1)
+
+    if matches:
+        return 'match', matches[0]['FaceId']
+    return 'no_match', None
+
+
+def recognize_cached(backend, door_id, image_bytes, lane=None):
+    """
+    recognize() behind the recent-frame cache: a byte-identical repeat of a
+    frame seen on this door and lane a few seconds ago reuses its outcome
+    without calling the backend.
+    """
+    cache = get_frame_cache()
+    key, cached = cache.get(door_id, image_bytes, lane)
+    if cached is not None:
+        print(f"Frame cache hit on door {door_id} lane {lane}: {cached[0]}")
+        return tuple(cached)
+    result = recognize(backend, image_bytes)
+    cache.put(key, list(result))
+    return result
+
+
+def lookup_employees(dynamodb_resource, face_ids):
+    """Fetches the employees for a set of FaceIds in one BatchGetItem. Returns {FaceId: item}."""
+    employees = {}
+    request = {'employees': {'Keys': [{'FaceId': face_id} for face_id in set(face_ids)]}}
+    while request and request['employees']['Keys']:
+        response = dynamodb_resource.batch_get_item(RequestItems=request)
+        for item in response['Responses'].get('employees', []):
+            employees[item['FaceId']] = item
+        request = response.get('UnprocessedKeys')
+    return employees
+
+
+def describe_employee(employee):
+    """Returns (full_name, employee_id) for an employees item."""
+    first_name = employee.get('FirstName', employee.get('full_name', 'Unknown'))
+    last_name = employee.get('LastName', '')
+    full_name = f"{first_name} {last_name}".strip()
+    employee_id = employee.get('Cedula', employee.get('employee_id', 'N/A'))
+    return full_name, employee_id
+
+
+def publish_decisions_safely(events, s3_client=None, bucket=None):
+    """
+    Publishes decision events without letting a queue or S3 failure change
+    the door decision. Unpublished events are logged (without their image) so
+    they can be recovered from CloudWatch Logs.
+    """
+    try:
+        publish_decisions(events, s3_client, bucket)
+    except Exception as e:
+        print(f"Failed to publish {len(events)} decision event(s): {str(e)}")
+        for decision in events:
+            print(json.dumps({
+                'unpublishedDecision': {k: v for k, v in decision.items() if k != 'image'}
+            }))
+
+
+@profiled
 def access_control_handler(event, context):
     """
     Handles access control by detecting the number of faces and then searching
@@ -14,94 +142,59 @@ def access_control_handler(event, context):
     - "Access Granted": If exactly one face is detected and it's a known employee.
     - "Access Denied": If exactly one face is detected but it's not a known employee.
     - "Unknown": If zero or more than one face is detected.
+
+    A JSON body with a "frames" list is handled by batch_access_control.
+
+    Alerting, image storage, logging and metrics happen in decision_worker:
+    the handler only publishes a decision event (see decision_events.py).
+    Repeated frames reuse a recent recognition result (see frame_cache.py).
     """
-    rekognition_client = boto3.client('rekognition')
+    backend = admitted(get_backend(), PRIORITY_ACCESS)
     dynamodb_resource = boto3.resource('dynamodb')
     s3_client = boto3.client('s3')
-    sns_client = boto3.client('sns')
-    cloudwatch_client = boto3.client('cloudwatch')
 
     try:
-        table = dynamodb_resource.Table('employees')
         unrecognized_faces_bucket = os.environ['UNRECOGNIZED_FACES_BUCKET']
-        sns_topic_arn = os.environ['SNS_TOPIC_ARN']
-        access_logs_table_name = os.environ.get('ACCESS_LOGS_TABLE')
+        door_id = get_door_id(event)
 
-        image_bytes = base64.b64decode(event['body'])
+        frames = parse_frames(event)
+        if frames is not None:
+            return batch_access_control(
+                frames, door_id, backend, dynamodb_resource, s3_client, unrecognized_faces_bucket
+            )
 
-        # Step 1: Detect and count faces in the image
-        detect_response = rekognition_client.detect_faces(Image={'Bytes': image_bytes})
+        image_bytes = base64.b64decode(event['body'])
 
-        num_faces = len(detect_response['FaceDetails'])
+        outcome, face_id = recognize_cached(backend, door_id, image_bytes)
 
-        # Step 2: Handle cases with 0 faces
-        if num_faces == 0:
+        # Handle cases with 0 faces
+        if outcome == 'no_face':
             return {
                 'statusCode': 400,
                 'body': json.dumps({
-                    'message': "No se detect\u00f3 ninguna cara"
+                    'message': "No se detectó ninguna cara"
                 })
             }
 
         # Handle cases with more than 1 face
-        if num_faces > 1:
+        if outcome == 'multiple_faces':
             return {
                 'statusCode': 400,
                 'body': json.dumps({
-                    'message': "Se detect\u00f3 m\u00e1s de una cara"
+                    'message': "Se detectó más de una cara"
                 })
             }
 
-        # Step 3: Handle "Access Granted" or "Access Denied" state (exactly 1 face)
-        search_response = rekognition_client.search_faces_by_image(
-            CollectionId='employees',
-            Image={'Bytes': image_bytes},
-            MaxFaces=1,
-            FaceMatchThreshold=95
-        )
-
-        if search_response['FaceMatches']:
-            face_match = search_response['FaceMatches'][0]
-            face_id = face_match['Face']['FaceId']
-
-            dynamodb_response = table.get_item(Key={'FaceId': face_id})
-
-            if 'Item' in dynamodb_response:
-                employee = dynamodb_response['Item']
-
-                first_name = employee.get('FirstName', employee.get('full_name', 'Unknown'))
-                last_name = employee.get('LastName', '')
-                full_name = f"{first_name} {last_name}".strip()
-                employee_id = employee.get('Cedula', employee.get('employee_id', 'N/A'))
-
-                # Log Access Granted
-                if access_logs_table_name:
-                    log_table = dynamodb_resource.Table(access_logs_table_name)
-                    log_table.put_item(Item={
-                        'LogId': str(uuid.uuid4()),
-                        'Timestamp': datetime.utcnow().isoformat(),
-                        'EmployeeId': employee_id,
-                        'EmployeeName': full_name,
-                        'Status': 'Access Granted'
-                    })
+        # Handle "Access Granted" or "Access Denied" state (exactly 1 face)
+        if outcome == 'match':
+            employee = lookup_employees(dynamodb_resource, [face_id]).get(face_id)
+
+            if employee:
+                full_name, employee_id = describe_employee(employee)
 
-                # Publish CloudWatch Metric
-                cloudwatch_client.put_metric_data(
-                    Namespace='BiometricAccessControl',
-                    MetricData=[
-                        {
-                            'MetricName': 'AccessAttempts',
-                            'Dimensions': [
-                                {
-                                    'Name': 'Status',
-                                    'Value': 'Granted'
-                                },
-                            ],
-                            'Value': 1,
-                            'Unit': 'Count'
-                        },
-                    ]
-                )
+                publish_decisions_safely([new_decision_event(
+                    'Access Granted', door_id, employee_id=employee_id, employee_name=full_name
+                )])
 
                 return {
                     'statusCode': 200,
@@ -111,59 +204,10 @@ def access_control_handler(event, context):
                     })
                 }
 
-        # If no match was found in the collection, upload image to S3 and send SNS alert
-        timestamp = datetime.utcnow().strftime('%Y-%m-%dT%H-%M-%SZ')
-        s3_key = f"unrecognized-face-{timestamp}.jpg"
-
-        s3_client.put_object(
-            Bucket=unrecognized_faces_bucket,
-            Key=s3_key,
-            Body=image_bytes,
-            ContentType='image/jpeg'
-        )
-
-        # Generate a presigned URL for the uploaded image
-        s3_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': unrecognized_faces_bucket, 'Key': s3_key},
-            ExpiresIn=3600  # URL expires in 1 hour
-        )
-
-        response = sns_client.publish(
-            TopicArn=sns_topic_arn,
-            Subject="ALERTA: Acceso Biométrico",
-            Message=f"Se detectó un desconocido. Se niega su acceso.\n\nFoto (válida por 1 hora): {s3_url}"
-        )
-        print(f"SNS Alert sent to topic: {sns_topic_arn}, MessageId: {response.get('MessageId')}")
-
-        # Log Access Denied
-        if access_logs_table_name:
-            log_table = dynamodb_resource.Table(access_logs_table_name)
-            log_table.put_item(Item={
-                'LogId': str(uuid.uuid4()),
-                'Timestamp': datetime.utcnow().isoformat(),
-                'EmployeeId': 'Unknown',
-                'EmployeeName': 'Unknown',
-                'Status': 'Access Denied'
-            })
-
-        # Publish CloudWatch Metric
-        cloudwatch_client.put_metric_data(
-            Namespace='BiometricAccessControl',
-            MetricData=[
-                {
-                    'MetricName': 'AccessAttempts',
-                    'Dimensions': [
-                        {
-                            'Name': 'Status',
-                            'Value': 'Denied'
-                        },
-                    ],
-                    'Value': 1,
-                    'Unit': 'Count'
-                },
-            ]
-        )
+        # If no match was found, the worker stores the image and sends the SNS alert
+        decision = new_decision_event('Access Denied', door_id)
+        decision['image'] = event['body']
+        publish_decisions_safely([decision], s3_client, unrecognized_faces_bucket)
 
         return {
             'statusCode': 403,
@@ -173,9 +217,30 @@ def access_control_handler(event, context):
             })
         }
 
-    except rekognition_client.exceptions.InvalidParameterException as e:
+    except AdmissionRejected as e:
+        # Recognition capacity exhausted: ask the kiosk to retry later
+        print(f"AdmissionRejected: {str(e)}")
+        return {
+            'statusCode': 429,
+            'headers': {'Retry-After': e.retry_after_header},
+            'body': json.dumps({
+                'status': 'Busy',
+                'message': 'Too many requests, please retry shortly.',
+                'retryAfter': int(e.retry_after_header)
+            })
+        }
+    except MalformedBatchError as e:
+        print(f"MalformedBatchError: {str(e)}")
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'status': 'Error',
+                'message': str(e)
+            })
+        }
+    except InvalidImageError as e:
         # This can happen if the image format is invalid
-        print(f"InvalidParameterException: {str(e)}")
+        print(f"InvalidImageError: {str(e)}")
         return {
             'statusCode': 400,
             'body': json.dumps({
@@ -192,3 +257,83 @@ def access_control_handler(event, context):
                 'message': f'Internal Server Error: {str(e)}'
             })
         }
+    finally:
+        get_frame_cache().report()
+
+
+def batch_access_control(frames, door_id, backend, dynamodb_resource, s3_client, unrecognized_faces_bucket):
+    """
+    Verifies several frames (one per lane of a turnstile bank) in one invocation.
+
+    Frames are recognized concurrently and the employee lookup is shared by the
+    whole batch, whose decision events are published together. Always returns
+    200 with one decision per frame, in request order, each with the status
+    code the single-image endpoint would have returned.
+    """
+    if not frames or len(frames) > MAX_BATCH_FRAMES:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'status': 'Error',
+                'message': f'A batch must contain between 1 and {MAX_BATCH_FRAMES} frames'
+            })
+        }
+
+    lanes = [str(frame.get('lane', index)) for index, frame in enumerate(frames)]
+
+    def recognize_frame(frame, lane):
+        try:
+            image_bytes = base64.b64decode(frame['image'])
+            # Cache entries are scoped to the lane: two lanes never share a result
+            return recognize_cached(backend, door_id, image_bytes, lane)
+        except AdmissionRejected as e:
+            print(f"AdmissionRejected: {str(e)}")
+            # Second element carries the Retry-After value instead of a FaceId
+            return 'throttled', e.retry_after_header
+        except (KeyError, ValueError, TypeError, InvalidImageError) as e:
+            print(f"Invalid frame: {str(e)}")
+            return 'invalid', None
+
+    with ThreadPoolExecutor(max_workers=len(frames)) as pool:
+        recognized = list(pool.map(recognize_frame, frames, lanes))
+
+    employees = lookup_employees(
+        dynamodb_resource,
+        [face_id for outcome, face_id in recognized if outcome == 'match']
+    )
+
+    results = []
+    decisions = []
+    for frame, lane, (outcome, face_id) in zip(frames, lanes, recognized):
+        if outcome == 'throttled':
+            results.append({'lane': lane, 'statusCode': 429, 'status': 'Busy',
+                            'message': 'Too many requests, please retry shortly.',
+                            'retryAfter': int(face_id)})
+        elif outcome == 'invalid':
+            results.append({'lane': lane, 'statusCode': 400, 'status': 'Error',
+                            'message': 'Invalid image format or parameter'})
+        elif outcome == 'no_face':
+            results.append({'lane': lane, 'statusCode': 400, 'message': "No se detectó ninguna cara"})
+        elif outcome == 'multiple_faces':
+            results.append({'lane': lane, 'statusCode': 400, 'message': "Se detectó más de una cara"})
+        elif outcome == 'match' and face_id in employees:
+            full_name, employee_id = describe_employee(employees[face_id])
+            decisions.append(new_decision_event(
+                'Access Granted', door_id, lane=lane, employee_id=employee_id, employee_name=full_name
+            ))
+            results.append({'lane': lane, 'statusCode': 200, 'status': 'Access Granted',
+                            'message': f"Bienvenido, {full_name} (ID: {employee_id})"})
+        else:
+            decision = new_decision_event('Access Denied', door_id, lane=lane)
+            decision['image'] = frame['image']
+            decisions.append(decision)
+            results.append({'lane': lane, 'statusCode': 403, 'status': 'Access Denied',
+                            'message': 'Face not recognized.'})
+
+    if decisions:
+        publish_decisions_safely(decisions, s3_client, unrecognized_faces_bucket)
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({'results': results})
+    }
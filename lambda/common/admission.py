@@ -0,0 +1,214 @@
+"""
+Admission control for recognition calls.
+
+Every backend operation goes through a per-operation token bucket held in the
+warm container. Throttling errors are retried with exponential backoff and
+full jitter, and each one halves the operation's admission rate, which then
+recovers additively on success (AIMD). The priority sets how a call behaves:
+access checks may queue briefly for a token and are retried, while
+registration calls must leave a reserve of tokens in the bucket, are not
+retried, and are rejected outright while the backend is cooling down from a
+throttle. A rejected call raises AdmissionRejected with the number of
+seconds the client should wait (sent back as 429 + Retry-After).
+
+Buckets and cool-downs are per container, and access checks and registrations
+run in different Lambda functions, so they never compete for the same bucket.
+Across containers and functions the Rekognition quota can be split with
+reserved concurrency (AccessControlReservedConcurrencyParameter and
+RegistrationReservedConcurrencyParameter in the stack, off by default): a
+function's combined rate is then at most its reserved concurrency times the
+per-container rate. Requests over that cap are throttled by Lambda before the
+handler runs, so they get no Retry-After from this module. Rates
+can be set per operation with ADMISSION_RATE_<OPERATION>
+(e.g. ADMISSION_RATE_SEARCH_FACES=5).
+"""
+import os
+import math
+import random
+import threading
+import time
+
+from recognition_backend import RecognitionBackend, ThrottledError
+
+PRIORITY_ACCESS = 'access'
+PRIORITY_REGISTRATION = 'registration'
+
+# Sustained calls per second per container, and burst size in seconds of rate
+DEFAULT_RATES = {
+    'detect_faces': 5.0,
+    'search_faces': 5.0,
+    'index_face': 1.0,
+    'delete_faces': 1.0,
+}
+BURST_SECONDS = 2.0
+# Fraction of the bucket that low-priority calls may not use
+LOW_PRIORITY_RESERVE = 0.5
+MIN_RATE_FRACTION = 0.1
+RECOVERY_STEP_FRACTION = 0.05
+
+MAX_ATTEMPTS = {PRIORITY_ACCESS: 3, PRIORITY_REGISTRATION: 1}
+BACKOFF_BASE_SECONDS = 0.1
+BACKOFF_CAP_SECONDS = 2.0
+# How long an access check may wait for a token before being rejected
+MAX_ACCESS_QUEUE_SECONDS = 1.0
+
+
+class AdmissionRejected(Exception):
+    """The call was not admitted; retry after retry_after seconds."""
+
+    def __init__(self, operation, retry_after):
+        super().__init__(f'{operation} rejected by admission control, retry after {retry_after:.1f}s')
+        self.operation = operation
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self):
+        """Retry-After value: whole seconds, at least 1."""
+        return str(max(1, int(math.ceil(self.retry_after))))
+
+
+class TokenBucket:
+    """Thread-safe token bucket whose refill rate can be adjusted at runtime."""
+
+    def __init__(self, rate):
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    @property
+    def capacity(self):
+        return max(1.0, self.rate * BURST_SECONDS)
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, reserve=0.0):
+        """
+        Takes one token if at least reserve * capacity tokens remain afterwards.
+        Returns 0 when admitted, otherwise the seconds until it would be.
+        """
+        with self.lock:
+            self._refill(time.monotonic())
+            needed = 1.0 + reserve * self.capacity
+            if self.tokens >= needed:
+                self.tokens -= 1.0
+                return 0.0
+            return (needed - self.tokens) / self.rate
+
+    def decrease(self):
+        with self.lock:
+            self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2.0)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def increase(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY_STEP_FRACTION)
+
+
+class AdmissionController:
+    """Per-operation token buckets plus a shared cool-down after throttling."""
+
+    def __init__(self, rates=None):
+        rates = dict(DEFAULT_RATES, **(rates or {}))
+        self.buckets = {operation: TokenBucket(rate) for operation, rate in rates.items()}
+        self.cooldown_until = 0.0
+        self.lock = threading.Lock()
+
+    def _admit(self, operation, priority):
+        bucket = self.buckets[operation]
+        if priority != PRIORITY_ACCESS:
+            cooldown = self.cooldown_until - time.monotonic()
+            if cooldown > 0:
+                raise AdmissionRejected(operation, cooldown)
+            wait = bucket.try_acquire(reserve=LOW_PRIORITY_RESERVE)
+        else:
+            # Access checks briefly queue for a token instead of failing the door
+            waited = 0.0
+            wait = bucket.try_acquire()
+            while wait and waited + wait <= MAX_ACCESS_QUEUE_SECONDS:
+                time.sleep(wait)
+                waited += wait
+                wait = bucket.try_acquire()
+        if wait:
+            raise AdmissionRejected(operation, wait)
+
+    def call(self, operation, priority, function, *args, **kwargs):
+        """Runs function under admission control for operation at the given priority."""
+        bucket = self.buckets[operation]
+        max_attempts = MAX_ATTEMPTS.get(priority, 1)
+
+        for attempt in range(max_attempts):
+            self._admit(operation, priority)
+            try:
+                result = function(*args, **kwargs)
+            except ThrottledError as e:
+                print(f"Throttled on {operation} (attempt {attempt + 1}/{max_attempts}): {e}")
+                bucket.decrease()
+                backoff = random.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+                with self.lock:
+                    self.cooldown_until = max(self.cooldown_until, time.monotonic() + BACKOFF_CAP_SECONDS)
+                if attempt + 1 == max_attempts:
+                    raise AdmissionRejected(operation, BACKOFF_CAP_SECONDS)
+                time.sleep(backoff)
+                continue
+            bucket.increase()
+            return result
+
+
+class AdmittedBackend(RecognitionBackend):
+    """Wraps a backend so every call goes through the admission controller."""
+
+    def __init__(self, backend, controller, priority):
+        self.backend = backend
+        self.controller = controller
+        self.priority = priority
+
+    def detect_faces(self, image_bytes):
+        return self.controller.call('detect_faces', self.priority, self.backend.detect_faces, image_bytes)
+
+    def search_faces(self, image_bytes, collection_id, threshold, max_faces=1):
+        return self.controller.call(
+            'search_faces', self.priority, self.backend.search_faces,
+            image_bytes, collection_id, threshold, max_faces=max_faces
+        )
+
+    def index_face(self, image_bytes, collection_id, external_id):
+        return self.controller.call(
+            'index_face', self.priority, self.backend.index_face,
+            image_bytes, collection_id, external_id
+        )
+
+    def index_face_from_s3(self, bucket, key, collection_id, external_id):
+        return self.controller.call(
+            'index_face', self.priority, self.backend.index_face_from_s3,
+            bucket, key, collection_id, external_id
+        )
+
+    def delete_faces(self, collection_id, face_ids):
+        return self.controller.call(
+            'delete_faces', self.priority, self.backend.delete_faces, collection_id, face_ids
+        )
+
+
+_controller = None
+
+
+def get_controller():
+    """Returns the container-wide admission controller, configured from ADMISSION_RATE_* variables."""
+    global _controller
+    if _controller is None:
+        rates = {}
+        for operation in DEFAULT_RATES:
+            value = os.environ.get(f'ADMISSION_RATE_{operation.upper()}')
+            if value:
+                rates[operation] = float(value)
+        _controller = AdmissionController(rates)
+    return _controller
+
+
+def admitted(backend, priority):
+    """Returns backend wrapped with the container-wide admission controller."""
+    return AdmittedBackend(backend, get_controller(), priority)
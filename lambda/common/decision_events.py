@@ -0,0 +1,143 @@
+"""
+Access decision events.
+
+access_control_handler publishes one compact event per decision and returns;
+the decision_worker Lambda batch-consumes them from SQS to store images, send
+alerts, write access logs and publish metrics.
+
+The queue is selected with DECISION_QUEUE_URL: an SQS queue URL, or 'local'
+for an in-process queue (LocalDecisionQueue) used when running offline.
+
+Event fields: eventId, timestamp, status ('Access Granted' | 'Access Denied'),
+doorId, lane (batch requests only), employeeId, employeeName, and for denials
+either image (base64 JPEG) or imageKey (already uploaded, for large images).
+"""
+import base64
+import json
+import os
+import uuid
+from datetime import datetime
+
+UNRECOGNIZED_FACES_PREFIX = 'unrecognized-faces'
+# SQS limit for a message and for a whole SendMessageBatch request
+MAX_MESSAGE_BYTES = 256 * 1024
+MAX_BATCH_MESSAGES = 10
+
+
+def build_unrecognized_face_keys(door_id, event_id, now):
+    """
+    Builds the S3 keys of an unrecognized face and its thumbnail.
+
+    Keys are partitioned by date and door so writes spread over many prefixes,
+    and derived from the event ID so redelivered events overwrite, not duplicate:
+    unrecognized-faces/2025/01/31/door-1/T14-05-09Z-<event id>.jpg
+    """
+    base = (
+        f"{UNRECOGNIZED_FACES_PREFIX}/{now.strftime('%Y/%m/%d')}/{door_id}/"
+        f"T{now.strftime('%H-%M-%S')}Z-{event_id}"
+    )
+    return f"{base}.jpg", f"{base}-thumb.jpg"
+
+
+def new_decision_event(status, door_id, lane=None, employee_id='Unknown', employee_name='Unknown'):
+    """Returns a decision event with a fresh eventId and timestamp."""
+    event = {
+        'eventId': uuid.uuid4().hex,
+        'timestamp': datetime.utcnow().isoformat(),
+        'status': status,
+        'doorId': door_id,
+        'employeeId': employee_id,
+        'employeeName': employee_name,
+    }
+    if lane is not None:
+        event['lane'] = lane
+    return event
+
+
+class SqsDecisionQueue:
+    """Publishes decision events to SQS with as few SendMessageBatch calls as the limits allow."""
+
+    def __init__(self, queue_url, sqs_client=None):
+        if sqs_client is None:
+            import boto3
+            sqs_client = boto3.client('sqs')
+        self.queue_url = queue_url
+        self.client = sqs_client
+
+    def publish(self, bodies):
+        batch, batch_bytes = [], 0
+        for body in bodies:
+            if batch and (len(batch) == MAX_BATCH_MESSAGES or batch_bytes + len(body) > MAX_MESSAGE_BYTES):
+                self._send(batch)
+                batch, batch_bytes = [], 0
+            batch.append(body)
+            batch_bytes += len(body)
+        if batch:
+            self._send(batch)
+
+    def _send(self, bodies):
+        response = self.client.send_message_batch(
+            QueueUrl=self.queue_url,
+            Entries=[{'Id': str(i), 'MessageBody': body} for i, body in enumerate(bodies)]
+        )
+        if response.get('Failed'):
+            raise RuntimeError(f"Failed to enqueue decision events: {response['Failed']}")
+
+
+class LocalDecisionQueue:
+    """In-process stand-in for the SQS queue, for offline runs and tests."""
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, bodies):
+        self.messages.extend(bodies)
+
+    def drain(self, worker):
+        """Feeds all queued messages to worker(event, context) as one SQS-shaped batch."""
+        messages, self.messages = self.messages, []
+        event = {
+            'Records': [
+                {'messageId': str(uuid.uuid4()), 'body': body, 'eventSource': 'aws:sqs'}
+                for body in messages
+            ]
+        }
+        return worker(event, None)
+
+
+_queue = None
+
+
+def get_queue():
+    """Returns the queue configured by DECISION_QUEUE_URL, reused across warm invocations."""
+    global _queue
+    if _queue is None:
+        queue_url = os.environ['DECISION_QUEUE_URL']
+        _queue = LocalDecisionQueue() if queue_url == 'local' else SqsDecisionQueue(queue_url)
+    return _queue
+
+
+def publish_decisions(events, s3_client=None, bucket=None):
+    """
+    Publishes decision events. A denial whose image does not fit in a message
+    has the image uploaded to its final key here and travels as imageKey.
+    """
+    bodies = []
+    for event in events:
+        body = json.dumps(event)
+        if len(body) > MAX_MESSAGE_BYTES:
+            image_key, _ = build_unrecognized_face_keys(
+                event['doorId'], event['eventId'], datetime.fromisoformat(event['timestamp'])
+            )
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=image_key,
+                Body=base64.b64decode(event['image']),
+                ContentType='image/jpeg',
+                Tagging='kind=full'
+            )
+            event = dict(event, imageKey=image_key)
+            del event['image']
+            body = json.dumps(event)
+        bodies.append(body)
+    get_queue().publish(bodies)
@@ -0,0 +1,180 @@
+"""
+Short-lived cache of recognition results for repeated frames.
+
+Kiosk users often press "Verify Access" several times in a row, and the kiosk
+resends the same captured frame each time. A frame whose bytes are identical
+(SHA-256) to one recognized seconds ago on the same door and lane reuses that
+result instead of calling the recognition backend again. Only the recognition
+outcome is cached: employee lookups and decision events still happen for
+every request.
+
+Matching is deliberately exact. Perceptual hashes of kiosk frames are
+dominated by the background and framing, so two different people at the same
+door can hash alike; a near-duplicate must never reuse somebody else's match.
+
+Entries live in the warm container (LRU, bounded) and, when FRAME_CACHE_TABLE
+is set, in a DynamoDB table shared by all containers (expired by the table
+TTL on ExpiresAt). Shared-table calls are not retried and time out quickly;
+a failed call counts as a miss.
+
+Environment variables:
+- FRAME_CACHE_TTL_SECONDS: how long a result is reused (default 5, 0 disables)
+- FRAME_CACHE_MAX_ENTRIES: size of the in-container cache (default 256)
+- FRAME_CACHE_TABLE: optional shared DynamoDB table (hash key CacheKey)
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+METRICS_NAMESPACE = 'BiometricAccessControl'
+# The shared table is only an optimization: one attempt with short timeouts,
+# so a slow or throttled table can never delay the door decision
+SHARED_CONNECT_TIMEOUT_SECONDS = 0.2
+SHARED_READ_TIMEOUT_SECONDS = 0.2
+
+
+def frame_key(door_id, lane, image_bytes):
+    """Returns the cache key of a frame: door, lane and SHA-256 of the image bytes."""
+    return f"{door_id}#{'' if lane is None else lane}#{hashlib.sha256(image_bytes).hexdigest()}"
+
+
+class FrameCache:
+    """Thread-safe TTL + LRU cache of recognition results per door and lane."""
+
+    def __init__(self, ttl_seconds=5.0, max_entries=256, table=None):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.table = table
+        # key -> (expires_at, result)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.total_hits = 0
+        self.total_lookups = 0
+
+    @property
+    def enabled(self):
+        return self.ttl_seconds > 0
+
+    def _get_local(self, key, now):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= now:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def _put_local(self, key, result, expires_at):
+        with self.lock:
+            self.entries[key] = (expires_at, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _get_shared(self, key, now):
+        try:
+            item = self.table.get_item(Key={'CacheKey': key}).get('Item')
+        except Exception as e:
+            # The shared store is an optimization, never fail the request on it
+            print(f"Frame cache read failed: {e}")
+            return None
+        # TTL deletion is lazy, expired items may still be returned
+        if not item or item['ExpiresAt'] <= now:
+            return None
+        return json.loads(item['Result'])
+
+    def _put_shared(self, key, result, expires_at):
+        try:
+            self.table.put_item(Item={
+                'CacheKey': key,
+                'Result': json.dumps(result),
+                'ExpiresAt': int(expires_at) + 1
+            })
+        except Exception as e:
+            print(f"Frame cache write failed: {e}")
+
+    def get(self, door_id, image_bytes, lane=None):
+        """Returns (key, result); result is None on a miss and key is passed back to put()."""
+        if not self.enabled:
+            return None, None
+        key = frame_key(door_id, lane, image_bytes)
+        now = time.time()
+        result = self._get_local(key, now)
+        if result is None and self.table is not None:
+            result = self._get_shared(key, now)
+            if result is not None:
+                self._put_local(key, result, now + self.ttl_seconds)
+        with self.lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return key, result
+
+    def put(self, key, result):
+        """Stores a JSON-serializable recognition result for the key returned by get()."""
+        if key is None:
+            return
+        expires_at = time.time() + self.ttl_seconds
+        self._put_local(key, result, expires_at)
+        if self.table is not None:
+            self._put_shared(key, result, expires_at)
+
+    def report(self):
+        """
+        Logs this container's hits and misses since the last report as CloudWatch
+        embedded metrics (no API call), and returns the cumulative hit rate.
+        """
+        with self.lock:
+            hits, misses = self.hits, self.misses
+            self.hits = self.misses = 0
+            self.total_hits += hits
+            self.total_lookups += hits + misses
+            hit_rate = self.total_hits / self.total_lookups if self.total_lookups else 0.0
+        if hits or misses:
+            print(json.dumps({
+                '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': METRICS_NAMESPACE,
+                        'Dimensions': [[]],
+                        'Metrics': [
+                            {'Name': 'FrameCacheHits', 'Unit': 'Count'},
+                            {'Name': 'FrameCacheMisses', 'Unit': 'Count'}
+                        ]
+                    }]
+                },
+                'FrameCacheHits': hits,
+                'FrameCacheMisses': misses,
+                'FrameCacheHitRate': round(hit_rate, 3)
+            }))
+        return hit_rate
+
+
+_cache = None
+
+
+def get_frame_cache():
+    """Returns the container-wide frame cache, configured from FRAME_CACHE_* variables."""
+    global _cache
+    if _cache is None:
+        table = None
+        table_name = os.environ.get('FRAME_CACHE_TABLE')
+        if table_name:
+            import boto3
+            from botocore.config import Config
+            table = boto3.resource('dynamodb', config=Config(
+                retries={'mode': 'standard', 'max_attempts': 1},
+                connect_timeout=SHARED_CONNECT_TIMEOUT_SECONDS,
+                read_timeout=SHARED_READ_TIMEOUT_SECONDS
+            )).Table(table_name)
+        _cache = FrameCache(
+            ttl_seconds=float(os.environ.get('FRAME_CACHE_TTL_SECONDS', '5')),
+            max_entries=int(os.environ.get('FRAME_CACHE_MAX_ENTRIES', '256')),
+            table=table
+        )
+    return _cache
@@ -0,0 +1,178 @@
+"""
+Opt-in CPU and memory profiling for Lambda handlers.
+
+A handler decorated with @profiled runs normally unless profiling is requested,
+either:
+- for a sampled fraction of invocations: PROFILING_ENABLED=true and
+  PROFILE_SAMPLE_RATE (0-1, default 1; a malformed value disables sampling), or
+- for one request: an X-Profile-Request header '<unix ts>:<signature>', where
+  signature is the hex HMAC-SHA256 of '<unix ts>:<handler name>' with
+  PROFILING_SECRET. Signed requests expire after SIGNATURE_MAX_AGE_SECONDS.
+
+A profiled invocation runs under cProfile and tracemalloc. Three files are
+written to PROFILE_OUTPUT (a directory, default /tmp/profiles, or an
+s3://bucket/prefix URL):
+- <handler>-<timestamp>-<id>.prof: cProfile stats (python -m pstats, snakeviz)
+- <handler>-<timestamp>-<id>.tracemalloc: tracemalloc snapshot (Snapshot.load)
+- <handler>-<timestamp>-<id>.txt: summary of both, also printed to the log
+"""
+import cProfile
+import functools
+import hashlib
+import hmac
+import io
+import os
+import pstats
+import random
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+PROFILE_HEADER = 'x-profile-request'
+SIGNATURE_MAX_AGE_SECONDS = 300
+DEFAULT_OUTPUT = '/tmp/profiles'
+TOP_FUNCTIONS = 25
+TOP_ALLOCATIONS = 15
+TRACEMALLOC_FRAMES = 10
+
+
+def sign_request(secret, handler_name, timestamp=None):
+    """Returns an X-Profile-Request header value for handler_name."""
+    timestamp = int(time.time() if timestamp is None else timestamp)
+    message = f'{timestamp}:{handler_name}'.encode()
+    signature = hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+    return f'{timestamp}:{signature}'
+
+
+def has_valid_signature(event, handler_name):
+    """True if the event carries a fresh X-Profile-Request header signed with PROFILING_SECRET."""
+    secret = os.environ.get('PROFILING_SECRET')
+    if not secret or not isinstance(event, dict):
+        return False
+    headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    value = headers.get(PROFILE_HEADER)
+    if not value or ':' not in value:
+        return False
+
+    timestamp = value.split(':', 1)[0]
+    try:
+        if abs(time.time() - int(timestamp)) > SIGNATURE_MAX_AGE_SECONDS:
+            return False
+    except ValueError:
+        return False
+    return hmac.compare_digest(value, sign_request(secret, handler_name, int(timestamp)))
+
+
+def sample_rate():
+    """PROFILE_SAMPLE_RATE as a float; a malformed value disables sampling instead of failing the request."""
+    value = os.environ.get('PROFILE_SAMPLE_RATE', '1')
+    try:
+        return float(value)
+    except ValueError:
+        print(f"Invalid PROFILE_SAMPLE_RATE {value!r}, sampled profiling disabled")
+        return 0.0
+
+
+def should_profile(event, handler_name):
+    """Decides whether this invocation is profiled."""
+    if has_valid_signature(event, handler_name):
+        return True
+    if os.environ.get('PROFILING_ENABLED', 'false').lower() != 'true':
+        return False
+    return random.random() < sample_rate()
+
+
+def summarize(profiler, snapshot, handler_name, elapsed, peak):
+    """Returns a text report with the slowest functions and the largest allocations."""
+    out = io.StringIO()
+    out.write(f'Profile of {handler_name}: {elapsed * 1000:.1f} ms, peak traced memory {peak / 1024:.1f} KiB\n\n')
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+    out.write('Top allocations (by line):\n')
+    for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+        out.write(f'  {stat}\n')
+    return out.getvalue()
+
+
+def write_outputs(files):
+    """Writes {file name: bytes} to PROFILE_OUTPUT. Returns where they went."""
+    output = os.environ.get('PROFILE_OUTPUT', DEFAULT_OUTPUT)
+    if output.startswith('s3://'):
+        import boto3
+        bucket, _, prefix = output[len('s3://'):].partition('/')
+        s3_client = boto3.client('s3')
+        for name, data in files.items():
+            key = f"{prefix.rstrip('/')}/{name}" if prefix else name
+            s3_client.put_object(Bucket=bucket, Key=key, Body=data)
+    else:
+        os.makedirs(output, exist_ok=True)
+        for name, data in files.items():
+            with open(os.path.join(output, name), 'wb') as f:
+                f.write(data)
+    return output
+
+
+def run_profiled(handler, event, context):
+    """Runs the handler under cProfile and tracemalloc and stores the results."""
+    handler_name = handler.__name__
+    already_tracing = tracemalloc.is_tracing()
+    if already_tracing:
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    profiler = cProfile.Profile()
+
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        return handler(event, context)
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - start
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        if not already_tracing:
+            tracemalloc.stop()
+
+        # Profiling must never turn a handled request into a failure
+        try:
+            base = f"{handler_name}-{datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')}-{uuid.uuid4().hex[:8]}"
+            summary = summarize(profiler, snapshot, handler_name, elapsed, peak)
+            print(summary)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                prof_path = os.path.join(tmp_dir, 'stats.prof')
+                snapshot_path = os.path.join(tmp_dir, 'snapshot.tracemalloc')
+                profiler.dump_stats(prof_path)
+                snapshot.dump(snapshot_path)
+                with open(prof_path, 'rb') as f:
+                    prof_data = f.read()
+                with open(snapshot_path, 'rb') as f:
+                    snapshot_data = f.read()
+            output = write_outputs({
+                f'{base}.prof': prof_data,
+                f'{base}.tracemalloc': snapshot_data,
+                f'{base}.txt': summary.encode(),
+            })
+            print(f"Profile written to {output}/{base}.*")
+        except Exception as e:
+            print(f"Failed to write profile: {e}")
+
+
+def profiled(handler):
+    """Decorator that profiles the sampled or explicitly requested invocations of a handler."""
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        # Runs outside the handler's error handling: profiling must never fail a request
+        try:
+            profile = should_profile(event, handler.__name__)
+        except Exception as e:
+            print(f"Profiling check failed: {e}")
+            profile = False
+        if not profile:
+            return handler(event, context)
+        return run_profiled(handler, event, context)
+
+    return wrapper
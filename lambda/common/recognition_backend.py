@@ -0,0 +1,343 @@
+"""
+Face recognition backends shared by the Lambda functions.
+
+Handlers talk to a RecognitionBackend instead of the Rekognition client, so the
+same code runs against Amazon Rekognition (default) or against a local engine
+that keeps face embeddings in a NumPy matrix (offline testing, edge sites with
+poor connectivity, latency baseline).
+
+The backend is selected with environment variables:
+- RECOGNITION_BACKEND: 'rekognition' (default) or 'local'
+- LOCAL_EMBEDDINGS_DIR: where the local engine persists its collections
+"""
+import io
+import os
+import random
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+try:
+    # Only needed by the local engine
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    # Default face detector/embedder of the local engine (128-d embeddings)
+    import face_recognition
+except ImportError:
+    face_recognition = None
+
+
+class InvalidImageError(Exception):
+    """The image could not be decoded or has no usable face."""
+
+
+class CollectionNotFoundError(Exception):
+    """The face collection does not exist."""
+
+
+class ThrottledError(Exception):
+    """The recognition service rejected the call because of its rate limits."""
+
+
+class RecognitionBackend(ABC):
+    """Interface implemented by every recognition backend."""
+
+    @abstractmethod
+    def detect_faces(self, image_bytes):
+        """Returns the number of faces in the image."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def search_faces(self, image_bytes, collection_id, threshold, max_faces=1):
+        """
+        Searches the collection for the largest face of the image.
+        Returns a list of {'FaceId', 'ExternalImageId', 'Similarity'} dicts,
+        best match first, with Similarity in [0, 100] and >= threshold.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def index_face(self, image_bytes, collection_id, external_id):
+        """Adds the face of the image to the collection. Returns its FaceId, or None if no face was found."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def index_face_from_s3(self, bucket, key, collection_id, external_id):
+        """Like index_face, for an image stored in S3."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_faces(self, collection_id, face_ids):
+        """Removes faces from the collection."""
+        raise NotImplementedError
+
+
+# Attempts for transient (5xx, connection) errors of calls made under admission control
+TRANSIENT_MAX_ATTEMPTS = 3
+TRANSIENT_BACKOFF_SECONDS = 0.1
+# botocore attempts of the retrying backend, used by callers without admission control
+RETRYING_MAX_ATTEMPTS = 5
+
+
+def is_transient_error(error):
+    """True for errors worth retrying that are not throttling: server errors and network failures."""
+    from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return True
+    if isinstance(error, ClientError):
+        return error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+    return False
+
+
+class RekognitionBackend(RecognitionBackend):
+    """
+    Amazon Rekognition implementation.
+
+    By default throttling errors are raised at once as ThrottledError, for the
+    admission controller (admission.py) to retry, while transient server and
+    network errors are retried here. With retry_throttling=True botocore's
+    standard retries handle both, for callers outside admission control.
+    """
+
+    def __init__(self, client=None, retry_throttling=False):
+        if client is None:
+            import boto3
+            from botocore.config import Config
+            max_attempts = RETRYING_MAX_ATTEMPTS if retry_throttling else 1
+            client = boto3.client('rekognition', config=Config(retries={'mode': 'standard', 'max_attempts': max_attempts}))
+        self.client = client
+        self.transient_attempts = 1 if retry_throttling else TRANSIENT_MAX_ATTEMPTS
+
+    def _call(self, operation, **kwargs):
+        for attempt in range(self.transient_attempts):
+            try:
+                return getattr(self.client, operation)(**kwargs)
+            except self.client.exceptions.InvalidParameterException as e:
+                raise InvalidImageError(str(e))
+            except self.client.exceptions.InvalidImageFormatException as e:
+                raise InvalidImageError(str(e))
+            except self.client.exceptions.ResourceNotFoundException as e:
+                raise CollectionNotFoundError(str(e))
+            except (self.client.exceptions.ThrottlingException,
+                    self.client.exceptions.ProvisionedThroughputExceededException,
+                    self.client.exceptions.LimitExceededException) as e:
+                raise ThrottledError(str(e))
+            except Exception as e:
+                if attempt + 1 == self.transient_attempts or not is_transient_error(e):
+                    raise
+                print(f"Transient error on {operation} (attempt {attempt + 1}/{self.transient_attempts}): {e}")
+                time.sleep(random.uniform(0, TRANSIENT_BACKOFF_SECONDS * 2 ** attempt))
+
+    def detect_faces(self, image_bytes):
+        response = self._call('detect_faces', Image={'Bytes': image_bytes})
+        return len(response['FaceDetails'])
+
+    def search_faces(self, image_bytes, collection_id, threshold, max_faces=1):
+        response = self._call(
+            'search_faces_by_image',
+            CollectionId=collection_id,
+            Image={'Bytes': image_bytes},
+            MaxFaces=max_faces,
+            FaceMatchThreshold=threshold
+        )
+        return [
+            {
+                'FaceId': match['Face']['FaceId'],
+                'ExternalImageId': match['Face'].get('ExternalImageId', ''),
+                'Similarity': match['Similarity']
+            }
+            for match in response['FaceMatches']
+        ]
+
+    def index_face(self, image_bytes, collection_id, external_id):
+        return self._index_face({'Bytes': image_bytes}, collection_id, external_id)
+
+    def index_face_from_s3(self, bucket, key, collection_id, external_id):
+        # Rekognition reads the object itself; the image never passes through the caller
+        return self._index_face({'S3Object': {'Bucket': bucket, 'Name': key}}, collection_id, external_id)
+
+    def _index_face(self, image, collection_id, external_id):
+        response = self._call(
+            'index_faces',
+            CollectionId=collection_id,
+            Image=image,
+            ExternalImageId=external_id,
+            DetectionAttributes=['ALL'],
+            MaxFaces=1,
+            QualityFilter="AUTO"
+        )
+        if not response['FaceRecords']:
+            return None
+        return response['FaceRecords'][0]['Face']['FaceId']
+
+    def delete_faces(self, collection_id, face_ids):
+        self._call('delete_faces', CollectionId=collection_id, FaceIds=list(face_ids))
+
+
+def default_embedder(image_bytes):
+    """Returns one L2-normalizable embedding row per face found in the image."""
+    try:
+        image = face_recognition.load_image_file(io.BytesIO(image_bytes))
+    except Exception as e:
+        raise InvalidImageError(f'Could not decode image: {e}')
+    locations = face_recognition.face_locations(image)
+    if not locations:
+        return np.empty((0, 128), dtype=np.float32)
+    # Largest face first, like Rekognition's search
+    locations.sort(key=lambda box: (box[2] - box[0]) * (box[1] - box[3]), reverse=True)
+    return np.asarray(face_recognition.face_encodings(image, locations), dtype=np.float32)
+
+
+class LocalEmbeddingBackend(RecognitionBackend):
+    """
+    Local engine: each collection is a float32 matrix of unit-length embeddings
+    (one row per face) persisted as <store_dir>/<collection_id>.npz. Search is a
+    single matrix-vector product (cosine similarity) plus a partial sort.
+
+    Writes are not coordinated between processes; use one writer per store.
+    """
+
+    def __init__(self, store_dir, embedder=None):
+        if np is None:
+            raise RuntimeError('LocalEmbeddingBackend requires numpy')
+        if embedder is None and face_recognition is None:
+            raise RuntimeError('LocalEmbeddingBackend requires face_recognition or an embedder function')
+        self.store_dir = store_dir
+        self.embedder = embedder or default_embedder
+        self.collections = {}
+        # Last (image, embeddings) per thread: a verification calls detect_faces
+        # and then search_faces on the same image, which is embedded only once
+        self.last_embedding = threading.local()
+
+    def _path(self, collection_id):
+        return os.path.join(self.store_dir, f'{collection_id}.npz')
+
+    def _load(self, collection_id, create=False):
+        if collection_id not in self.collections:
+            path = self._path(collection_id)
+            if os.path.exists(path):
+                with np.load(path) as data:
+                    self.collections[collection_id] = {
+                        'embeddings': data['embeddings'],
+                        'face_ids': data['face_ids'],
+                        'external_ids': data['external_ids'],
+                    }
+            elif create:
+                self.collections[collection_id] = {
+                    'embeddings': None,
+                    'face_ids': np.array([], dtype=str),
+                    'external_ids': np.array([], dtype=str),
+                }
+            else:
+                raise CollectionNotFoundError(f'Collection {collection_id} not found in {self.store_dir}')
+        return self.collections[collection_id]
+
+    def _save(self, collection_id):
+        collection = self.collections[collection_id]
+        os.makedirs(self.store_dir, exist_ok=True)
+        tmp_path = self._path(collection_id) + '.tmp.npz'
+        np.savez(tmp_path, **collection)
+        os.replace(tmp_path, self._path(collection_id))
+
+    def _embed(self, image_bytes):
+        last = getattr(self.last_embedding, 'value', None)
+        if last is not None and last[0] == image_bytes:
+            return last[1]
+        embeddings = np.asarray(self.embedder(image_bytes), dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings / np.maximum(norms, 1e-12)
+        self.last_embedding.value = (image_bytes, embeddings)
+        return embeddings
+
+    def detect_faces(self, image_bytes):
+        return len(self._embed(image_bytes))
+
+    def search_faces(self, image_bytes, collection_id, threshold, max_faces=1):
+        collection = self._load(collection_id)
+        embeddings = self._embed(image_bytes)
+        if len(embeddings) == 0:
+            raise InvalidImageError('No face detected in the image')
+        if collection['embeddings'] is None or len(collection['face_ids']) == 0:
+            return []
+
+        similarities = np.clip(collection['embeddings'] @ embeddings[0], 0.0, 1.0) * 100.0
+        k = min(max_faces, len(similarities))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return [
+            {
+                'FaceId': str(collection['face_ids'][i]),
+                'ExternalImageId': str(collection['external_ids'][i]),
+                'Similarity': float(similarities[i])
+            }
+            for i in top if similarities[i] >= threshold
+        ]
+
+    def index_face(self, image_bytes, collection_id, external_id):
+        collection = self._load(collection_id, create=True)
+        embeddings = self._embed(image_bytes)
+        if len(embeddings) == 0:
+            return None
+
+        face_id = str(uuid.uuid4())
+        row = embeddings[:1]
+        if collection['embeddings'] is None:
+            collection['embeddings'] = row
+        else:
+            collection['embeddings'] = np.vstack([collection['embeddings'], row])
+        collection['face_ids'] = np.append(collection['face_ids'], face_id)
+        collection['external_ids'] = np.append(collection['external_ids'], external_id)
+        self._save(collection_id)
+        return face_id
+
+    def index_face_from_s3(self, bucket, key, collection_id, external_id):
+        import boto3
+        image_bytes = boto3.client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+        return self.index_face(image_bytes, collection_id, external_id)
+
+    def delete_faces(self, collection_id, face_ids):
+        collection = self._load(collection_id)
+        keep = ~np.isin(collection['face_ids'], list(face_ids))
+        if collection['embeddings'] is not None:
+            collection['embeddings'] = collection['embeddings'][keep]
+        collection['face_ids'] = collection['face_ids'][keep]
+        collection['external_ids'] = collection['external_ids'][keep]
+        self._save(collection_id)
+
+
+_backend = None
+_retrying_backend = None
+
+
+def get_backend_name():
+    """Returns the backend selected by RECOGNITION_BACKEND: 'rekognition' or 'local'."""
+    return os.environ.get('RECOGNITION_BACKEND', 'rekognition')
+
+
+def get_backend():
+    """Returns the backend configured by RECOGNITION_BACKEND, reused across warm invocations."""
+    global _backend
+    if _backend is None:
+        if get_backend_name() == 'local':
+            _backend = LocalEmbeddingBackend(os.environ.get('LOCAL_EMBEDDINGS_DIR', '/tmp/embeddings'))
+        else:
+            _backend = RekognitionBackend()
+    return _backend
+
+
+def get_retrying_backend():
+    """
+    Returns a backend that retries throttling on its own, for calls made outside
+    admission control (rollbacks that must not be skipped, offline tools).
+    """
+    global _retrying_backend
+    if get_backend_name() == 'local':
+        # The local engine makes no remote calls and is never throttled
+        return get_backend()
+    if _retrying_backend is None:
+        _retrying_backend = RekognitionBackend(retry_throttling=True)
+    return _retrying_backend
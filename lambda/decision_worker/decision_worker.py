@@ -0,0 +1,229 @@
+import boto3
+import json
+import base64
+import io
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decision_events import build_unrecognized_face_keys
+# Packaged with the function from requirements.txt (see packagelambda in build.py)
+from PIL import Image
+
+# Initialize clients
+s3_client = boto3.client('s3')
+sns_client = boto3.client('sns')
+cloudwatch_client = boto3.client('cloudwatch')
+dynamodb = boto3.resource('dynamodb')
+
+# Environment variables
+UNRECOGNIZED_FACES_BUCKET = os.environ.get('UNRECOGNIZED_FACES_BUCKET')
+SNS_TOPIC_ARN = os.environ.get('SNS_TOPIC_ARN')
+ACCESS_LOGS_TABLE = os.environ.get('ACCESS_LOGS_TABLE')
+
+THUMBNAIL_SIZE = (160, 160)
+MAX_UPLOAD_WORKERS = 8
+
+
+def make_thumbnail(image_bytes):
+    """Returns a small JPEG thumbnail of the image, or None if it cannot be built."""
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img = img.convert('RGB')
+            img.thumbnail(THUMBNAIL_SIZE)
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=70)
+            return buffer.getvalue()
+    except Exception as e:
+        print(f"Thumbnail generation failed: {e}")
+        return None
+
+
+def store_unrecognized_face(decision):
+    """
+    Uploads the image (and its thumbnail) of a denied decision.
+    Returns (s3_key, alert text with presigned URLs).
+    """
+    s3_key, thumbnail_key = build_unrecognized_face_keys(
+        decision['doorId'], decision['eventId'], datetime.fromisoformat(decision['timestamp'])
+    )
+
+    if 'image' in decision:
+        image_bytes = base64.b64decode(decision['image'])
+        s3_client.put_object(
+            Bucket=UNRECOGNIZED_FACES_BUCKET,
+            Key=s3_key,
+            Body=image_bytes,
+            ContentType='image/jpeg',
+            Tagging='kind=full'
+        )
+    else:
+        # Too large for a message, already uploaded by access_control_handler
+        s3_key = decision['imageKey']
+        image_bytes = s3_client.get_object(Bucket=UNRECOGNIZED_FACES_BUCKET, Key=s3_key)['Body'].read()
+
+    # Generate a presigned URL for the uploaded image
+    s3_url = s3_client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': UNRECOGNIZED_FACES_BUCKET, 'Key': s3_key},
+        ExpiresIn=3600  # URL expires in 1 hour
+    )
+    message = f"Foto (válida por 1 hora): {s3_url}"
+
+    # Store a small thumbnail next to the full image for fast review
+    thumbnail_bytes = make_thumbnail(image_bytes)
+    if thumbnail_bytes:
+        s3_client.put_object(
+            Bucket=UNRECOGNIZED_FACES_BUCKET,
+            Key=thumbnail_key,
+            Body=thumbnail_bytes,
+            ContentType='image/jpeg',
+            Tagging='kind=thumbnail'
+        )
+        thumbnail_url = s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': UNRECOGNIZED_FACES_BUCKET, 'Key': thumbnail_key},
+            ExpiresIn=3600
+        )
+        message += f"\nMiniatura: {thumbnail_url}"
+
+    return s3_key, message
+
+
+def send_alerts(denied):
+    """
+    Sends one SNS alert per door for the denied (message_id, decision, photo_message)
+    items of the batch. Returns the message ids of the doors whose alert failed.
+    """
+    by_door = defaultdict(list)
+    for message_id, decision, photo_message in denied:
+        by_door[decision['doorId']].append((message_id, decision, photo_message))
+
+    failed = []
+    for door_id, door_denied in by_door.items():
+        if len(door_denied) == 1:
+            message = f"Se detectó un desconocido en la puerta {door_id}. Se niega su acceso.\n\n{door_denied[0][2]}"
+        else:
+            lines = [
+                f"{decision['timestamp']} (carril {decision.get('lane', '-')}): {photo_message}"
+                for message_id, decision, photo_message in door_denied
+            ]
+            message = (f"Se detectaron {len(door_denied)} desconocidos en la puerta {door_id}. "
+                       "Se niega su acceso.\n\n" + "\n\n".join(lines))
+
+        try:
+            response = sns_client.publish(
+                TopicArn=SNS_TOPIC_ARN,
+                Subject="ALERTA: Acceso Biométrico",
+                Message=message
+            )
+        except Exception as e:
+            # Only this door's records are redelivered, other doors are not alerted twice
+            print(f"Failed to send alert for door {door_id}: {e}")
+            failed.extend(message_id for message_id, decision, photo_message in door_denied)
+            continue
+        print(f"SNS Alert sent to topic: {SNS_TOPIC_ARN}, MessageId: {response.get('MessageId')}")
+    return failed
+
+
+def write_access_logs(decisions):
+    """Writes one access log per decision. LogId is the eventId, so redeliveries overwrite."""
+    if not ACCESS_LOGS_TABLE or not decisions:
+        return
+    log_table = dynamodb.Table(ACCESS_LOGS_TABLE)
+    with log_table.batch_writer(overwrite_by_pkeys=['LogId', 'Timestamp']) as batch:
+        for decision in decisions:
+            item = {
+                'LogId': decision['eventId'],
+                'Timestamp': decision['timestamp'],
+                'EmployeeId': decision['employeeId'],
+                'EmployeeName': decision['employeeName'],
+                'DoorId': decision['doorId'],
+                'Status': decision['status']
+            }
+            if 'lane' in decision:
+                item['Lane'] = decision['lane']
+            if 'imageKey' in decision:
+                item['ImageKey'] = decision['imageKey']
+            batch.put_item(Item=item)
+
+
+def publish_access_metrics(decisions):
+    """Publishes the AccessAttempts counts of the batch in a single call."""
+    granted = sum(1 for decision in decisions if decision['status'] == 'Access Granted')
+    denied = len(decisions) - granted
+    metric_data = [
+        {
+            'MetricName': 'AccessAttempts',
+            'Dimensions': [
+                {
+                    'Name': 'Status',
+                    'Value': status
+                },
+            ],
+            'Value': count,
+            'Unit': 'Count'
+        }
+        for status, count in (('Granted', granted), ('Denied', denied)) if count
+    ]
+    if metric_data:
+        cloudwatch_client.put_metric_data(
+            Namespace='BiometricAccessControl',
+            MetricData=metric_data
+        )
+
+
+def decision_worker(event, context):
+    """
+    Consumes a batch of access decision events from SQS.
+
+    Denied decisions get their images stored first; a record whose storage
+    fails is reported in batchItemFailures so SQS redelivers only that record
+    (and moves it to the dead-letter queue after repeated failures). The rest
+    of the batch is logged and counted together, and a log or metric failure
+    raises so the whole batch is retried; S3 keys and LogIds derive from the
+    eventId, so retries do not duplicate images or logs. Alerts are sent last,
+    once nothing else can fail the batch, and a door whose alert fails has
+    only its records redelivered (they are counted again in AccessAttempts),
+    so no denial is alerted twice.
+    """
+    failures = []
+    decisions = []
+    for record in event['Records']:
+        try:
+            decisions.append((record['messageId'], json.loads(record['body'])))
+        except ValueError as e:
+            print(f"Malformed decision event {record['messageId']}: {e}")
+            failures.append(record['messageId'])
+
+    denied = [(message_id, decision) for message_id, decision in decisions
+              if decision['status'] == 'Access Denied']
+
+    def store(item):
+        message_id, decision = item
+        try:
+            return store_unrecognized_face(decision)
+        except Exception as e:
+            print(f"Failed to store image of event {decision['eventId']}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=min(MAX_UPLOAD_WORKERS, max(len(denied), 1))) as pool:
+        stored = list(pool.map(store, denied))
+
+    alerts = []
+    for (message_id, decision), result in zip(denied, stored):
+        if result is None:
+            failures.append(message_id)
+            continue
+        decision['imageKey'], photo_message = result
+        decision.pop('image', None)
+        alerts.append((message_id, decision, photo_message))
+
+    processed = [decision for message_id, decision in decisions if message_id not in failures]
+
+    write_access_logs(processed)
+    publish_access_metrics(processed)
+    failures.extend(send_alerts(alerts))
+
+    print(f"Processed {len(processed)} decision events, {len(failures)} failed")
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failures]}
@@ -0,0 +1,167 @@
+import json
+import boto3
+import base64
+import os
+from boto3.dynamodb.conditions import Key, Attr
+
+# Initialize clients
+dynamodb = boto3.resource('dynamodb')
+
+# Environment variables
+TABLE_NAME = os.environ.get('EMPLOYEES_TABLE')
+CEDULA_INDEX_NAME = os.environ.get('CEDULA_INDEX_NAME', 'CedulaIndex')
+CITY_INDEX_NAME = os.environ.get('CITY_INDEX_NAME', 'CityIndex')
+
+DEFAULT_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+
+EMPLOYEE_FIELDS = ('FaceId', 'FirstName', 'LastName', 'Cedula', 'City')
+
+
+def encode_token(last_evaluated_key):
+    """Turns a DynamoDB LastEvaluatedKey into an opaque pagination token."""
+    if not last_evaluated_key:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(last_evaluated_key).encode('utf-8')).decode('utf-8')
+
+
+def decode_token(token):
+    """Inverse of encode_token. Raises ValueError on a malformed token."""
+    try:
+        return json.loads(base64.urlsafe_b64decode(token.encode('utf-8')))
+    except Exception:
+        raise ValueError('Invalid nextToken')
+
+
+def build_request(params):
+    """
+    Picks the cheapest DynamoDB operation for the given filters:
+    - cedula: Query on CedulaIndex (single item)
+    - city (+ namePrefix): Query on CityIndex, LastName begins_with namePrefix
+    - namePrefix only: paginated Scan filtered on LastName
+    - nothing: paginated Scan of the directory
+    """
+    cedula = params.get('cedula')
+    city = params.get('city')
+    name_prefix = params.get('namePrefix')
+
+    if cedula:
+        return 'query', {
+            'IndexName': CEDULA_INDEX_NAME,
+            'KeyConditionExpression': Key('Cedula').eq(cedula)
+        }
+
+    if city:
+        condition = Key('City').eq(city)
+        if name_prefix:
+            condition = condition & Key('LastName').begins_with(name_prefix)
+        return 'query', {
+            'IndexName': CITY_INDEX_NAME,
+            'KeyConditionExpression': condition
+        }
+
+    # Cedula guard items have no Cedula attribute and must not be listed
+    filter_expression = Attr('Cedula').exists()
+    if name_prefix:
+        filter_expression = filter_expression & Attr('LastName').begins_with(name_prefix)
+    return 'scan', {'FilterExpression': filter_expression}
+
+
+def employee_exists(event, context):
+    """
+    GET /employees/exists?cedula=<cedula>: public duplicate pre-check for the
+    registration form. Only answers whether the Cedula is registered; the
+    directory itself (GET /employees) requires IAM authorization.
+    """
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Content-Type': 'application/json'
+    }
+    try:
+        cedula = (event.get('queryStringParameters') or {}).get('cedula')
+        if not cedula:
+            return {
+                'statusCode': 400,
+                'headers': headers,
+                'body': json.dumps({'message': 'cedula is required'})
+            }
+
+        response = dynamodb.Table(TABLE_NAME).query(
+            IndexName=CEDULA_INDEX_NAME,
+            KeyConditionExpression=Key('Cedula').eq(cedula),
+            Select='COUNT',
+            Limit=1
+        )
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': json.dumps({'exists': response['Count'] > 0})
+        }
+
+    except Exception as e:
+        print(f"Internal Error: {str(e)}")
+        return {
+            'statusCode': 500,
+            'headers': headers,
+            'body': json.dumps({'message': f'Internal Server Error: {str(e)}'})
+        }
+
+
+def list_employees(event, context):
+    try:
+        params = event.get('queryStringParameters') or {}
+
+        try:
+            limit = min(int(params.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+            if limit < 1:
+                raise ValueError('limit must be positive')
+            start_key = decode_token(params['nextToken']) if params.get('nextToken') else None
+        except ValueError as e:
+            return {
+                'statusCode': 400,
+                'headers': {
+                    'Access-Control-Allow-Origin': '*',
+                    'Content-Type': 'application/json'
+                },
+                'body': json.dumps({'message': str(e)})
+            }
+
+        table = dynamodb.Table(TABLE_NAME)
+        operation, request = build_request(params)
+        request['Limit'] = limit
+        if start_key:
+            request['ExclusiveStartKey'] = start_key
+
+        if operation == 'query':
+            response = table.query(**request)
+        else:
+            response = table.scan(**request)
+
+        employees = [
+            {field: item[field] for field in EMPLOYEE_FIELDS if field in item}
+            for item in response.get('Items', [])
+        ]
+
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Content-Type': 'application/json'
+            },
+            'body': json.dumps({
+                'employees': employees,
+                'count': len(employees),
+                'nextToken': encode_token(response.get('LastEvaluatedKey'))
+            })
+        }
+
+    except Exception as e:
+        print(f"Internal Error: {str(e)}")
+        return {
+            'statusCode': 500,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Content-Type': 'application/json'
+            },
+            'body': json.dumps({'message': f'Internal Server Error: {str(e)}'})
+        }
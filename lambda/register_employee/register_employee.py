@@ -4,148 +4,380 @@ import base64
 import os
 import uuid
 import re
+import time
+from urllib.parse import unquote_plus
+from boto3.dynamodb.conditions import Key
+from recognition_backend import get_backend, get_retrying_backend, CollectionNotFoundError, InvalidImageError
+from admission import admitted, AdmissionRejected, PRIORITY_REGISTRATION
+from profiling import profiled
 
 # Initialize clients
-rekognition = boto3.client('rekognition')
+backend = get_backend()
+# Registrations back off instead of retrying; their share of the Rekognition
+# quota is capped by the function's reserved concurrency
+registration_backend = admitted(backend, PRIORITY_REGISTRATION)
 dynamodb = boto3.resource('dynamodb')
 cloudwatch_client = boto3.client('cloudwatch')
+s3_client = boto3.client('s3')
 
 # Environment variables
 TABLE_NAME = os.environ.get('EMPLOYEES_TABLE')
 COLLECTION_ID = os.environ.get('REKOGNITION_COLLECTION_ID', 'employees')
+CEDULA_INDEX_NAME = os.environ.get('CEDULA_INDEX_NAME', 'CedulaIndex')
+REGISTRATIONS_TABLE = os.environ.get('REGISTRATIONS_TABLE')
+ENROLLMENT_UPLOADS_BUCKET = os.environ.get('ENROLLMENT_UPLOADS_BUCKET')
 
+# Guard items that make Cedula unique: a GSI cannot enforce uniqueness, so every
+# employee is written together with a 'CEDULA#<cedula>' item in one transaction.
+# Guard items carry no Cedula attribute, so they stay out of the (sparse) GSIs.
+CEDULA_GUARD_PREFIX = 'CEDULA#'
+
+# Two-phase registration: photos are uploaded to uploads/<registrationId>.jpg
+UPLOAD_PREFIX = 'uploads/'
+UPLOAD_URL_EXPIRES_IN = 900
+# Pending registrations are removed by the table TTL after a day
+REGISTRATION_TTL_SECONDS = 86400
+# First invocation plus Lambda's async retries (MaximumRetryAttempts in the stack)
+MAX_UPLOAD_ATTEMPTS = 3
+
+
+class RegistrationError(Exception):
+    """A registration that cannot be completed, with the HTTP status to report."""
+
+    def __init__(self, status_code, message, headers=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.headers = headers or {}
+
+
+def build_response(status_code, body, headers=None):
+    """Builds an API Gateway proxy response with the CORS and JSON headers."""
+    return {
+        'statusCode': status_code,
+        'headers': dict({
+            'Access-Control-Allow-Origin': '*',
+            'Content-Type': 'application/json'
+        }, **(headers or {})),
+        'body': json.dumps(body)
+    }
+
+
+def find_employee_by_cedula(table, cedula):
+    """Returns the employee registered with this Cedula, or None."""
+    response = table.query(
+        IndexName=CEDULA_INDEX_NAME,
+        KeyConditionExpression=Key('Cedula').eq(cedula),
+        Limit=1
+    )
+    items = response.get('Items', [])
+    return items[0] if items else None
+
+
+def save_employee(item):
+    """
+    Writes the employee item and its Cedula guard atomically.
+    Returns False if the Cedula is already registered.
+    """
+    try:
+        dynamodb.meta.client.transact_write_items(TransactItems=[
+            {
+                'Put': {
+                    'TableName': TABLE_NAME,
+                    'Item': {
+                        'FaceId': CEDULA_GUARD_PREFIX + item['Cedula'],
+                        'EmployeeFaceId': item['FaceId']
+                    },
+                    'ConditionExpression': 'attribute_not_exists(FaceId)'
+                }
+            },
+            {
+                'Put': {
+                    'TableName': TABLE_NAME,
+                    'Item': item,
+                    'ConditionExpression': 'attribute_not_exists(FaceId)'
+                }
+            }
+        ])
+    except dynamodb.meta.client.exceptions.TransactionCanceledException as e:
+        print(f"Employee write cancelled: {e}")
+        return False
+    return True
+
+
+def validate_employee(body):
+    """
+    Validates the employee fields of a request body.
+    Returns (fields, external_image_id) or raises RegistrationError.
+    """
+    fields = {
+        'firstName': body.get('firstName'),
+        'lastName': body.get('lastName'),
+        'cedula': body.get('cedula'),
+        'city': body.get('city')
+    }
+
+    # Basic validation
+    if not all(fields.values()):
+        raise RegistrationError(400, 'Missing required fields')
+
+    # Sanitize Cedula for ExternalImageId
+    # Rekognition allows: [a-zA-Z0-9_.\-:]
+    # Remove any invalid characters from cedula
+    external_image_id = re.sub(r'[^a-zA-Z0-9_.\-:]', '', fields['cedula'])
+
+    if not external_image_id:
+        raise RegistrationError(400, 'Invalid characters in ID (Cedula)')
+
+    # Reject duplicates before spending a recognition call
+    if find_employee_by_cedula(dynamodb.Table(TABLE_NAME), fields['cedula']):
+        raise RegistrationError(409, f"An employee with ID (Cedula) {fields['cedula']} is already registered")
+
+    return fields, external_image_id
+
+
+def enroll(fields, external_image_id, image_bytes=None, s3_object=None):
+    """
+    Indexes the face (from bytes or from an S3 object) and saves the employee.
+    Returns the FaceId or raises RegistrationError.
+    """
+    # Index face in the recognition backend
+    try:
+        if s3_object:
+            face_id = registration_backend.index_face_from_s3(
+                s3_object['Bucket'], s3_object['Name'], COLLECTION_ID, external_image_id
+            )
+        else:
+            face_id = registration_backend.index_face(image_bytes, COLLECTION_ID, external_image_id)
+    except AdmissionRejected as e:
+        print(f"AdmissionRejected: {str(e)}")
+        raise RegistrationError(429, 'Too many requests, please retry shortly.',
+                                {'Retry-After': e.retry_after_header})
+    except CollectionNotFoundError:
+        raise RegistrationError(500, f'Rekognition collection {COLLECTION_ID} not found')
+    except InvalidImageError as e:
+        print(f"Error indexing image: {e}")
+        raise RegistrationError(400, 'Invalid image format')
+
+    # Check if a face was actually indexed
+    if not face_id:
+        raise RegistrationError(400, 'No face detected in the image')
+
+    print(f"Face indexed successfully. FaceId: {face_id}")
+
+    # Save to DynamoDB
+    item = {
+        'FaceId': face_id,
+        'FirstName': fields['firstName'],
+        'LastName': fields['lastName'],
+        'Cedula': fields['cedula'],
+        'City': fields['city'],
+        'CreatedAt': str(uuid.uuid4()) # Or timestamp
+    }
+
+    if not save_employee(item):
+        # Lost a race with a concurrent registration of the same Cedula.
+        # The rollback bypasses admission control so it is never shed, and
+        # retries throttling itself so a throttle cannot leave an orphaned face.
+        get_retrying_backend().delete_faces(COLLECTION_ID, [face_id])
+        raise RegistrationError(409, f"An employee with ID (Cedula) {fields['cedula']} is already registered")
+    print(f"Employee saved to DynamoDB: {item}")
+
+    # Publish CloudWatch Metric
+    cloudwatch_client.put_metric_data(
+        Namespace='BiometricAccessControl',
+        MetricData=[
+            {
+                'MetricName': 'EmployeeRegistrations',
+                'Value': 1,
+                'Unit': 'Count'
+            },
+        ]
+    )
+    return face_id
+
+
+def start_registration(fields, external_image_id):
+    """
+    Phase 1 of the two-phase flow: stores a pending registration and returns
+    a presigned URL where the client PUTs the raw JPEG photo.
+    """
+    registration_id = uuid.uuid4().hex
+    dynamodb.Table(REGISTRATIONS_TABLE).put_item(Item={
+        'RegistrationId': registration_id,
+        'Status': 'PENDING_UPLOAD',
+        'FirstName': fields['firstName'],
+        'LastName': fields['lastName'],
+        'Cedula': fields['cedula'],
+        'City': fields['city'],
+        'ExternalImageId': external_image_id,
+        'ExpiresAt': int(time.time()) + REGISTRATION_TTL_SECONDS
+    })
+
+    upload_url = s3_client.generate_presigned_url(
+        'put_object',
+        Params={
+            'Bucket': ENROLLMENT_UPLOADS_BUCKET,
+            'Key': f'{UPLOAD_PREFIX}{registration_id}.jpg',
+            'ContentType': 'image/jpeg'
+        },
+        ExpiresIn=UPLOAD_URL_EXPIRES_IN
+    )
+
+    return build_response(202, {
+        'message': 'Upload the photo to uploadUrl with a PUT (Content-Type: image/jpeg)',
+        'registrationId': registration_id,
+        'uploadUrl': upload_url,
+        'expiresIn': UPLOAD_URL_EXPIRES_IN
+    })
+
+
+@profiled
 def register_employee(event, context):
-    print("Received event: " + json.dumps(event))
+    """
+    POST /register.
+
+    With an 'image' (base64) in the body the employee is registered synchronously.
+    Without it, a two-phase registration is started: the response carries a
+    presigned upload URL, the upload triggers process_registration_upload, and
+    GET /register/{registrationId} (registration_status) reports the outcome.
+    """
+    # The body can hold a multi-megabyte image: log only its size
+    print(f"Received {event.get('httpMethod')} {event.get('path')} request, body size: {len(event.get('body') or '')}")
 
     try:
         # Parse input
         body = json.loads(event['body'])
-        image_base64 = body.get('image')
-        first_name = body.get('firstName')
-        last_name = body.get('lastName')
-        cedula = body.get('cedula')
-        city = body.get('city')
-
-        # Basic validation
-        if not all([image_base64, first_name, last_name, cedula, city]):
-            return {
-                'statusCode': 400,
-                'headers': {
-                    'Access-Control-Allow-Origin': '*',
-                    'Content-Type': 'application/json'
-                },
-                'body': json.dumps({'message': 'Missing required fields'})
-            }
+        fields, external_image_id = validate_employee(body)
 
-        # Sanitize Cedula for ExternalImageId
-        # Rekognition allows: [a-zA-Z0-9_.\-:]
-        # Remove any invalid characters from cedula
-        external_image_id = re.sub(r'[^a-zA-Z0-9_.\-:]', '', cedula)
-
-        if not external_image_id:
-             return {
-                'statusCode': 400,
-                'headers': {
-                    'Access-Control-Allow-Origin': '*',
-                    'Content-Type': 'application/json'
-                },
-                'body': json.dumps({'message': 'Invalid characters in ID (Cedula)'})
-            }
+        image_base64 = body.get('image')
+        if not image_base64:
+            return start_registration(fields, external_image_id)
 
         # Decode image
         try:
             image_bytes = base64.b64decode(image_base64)
         except Exception as e:
             print(f"Error decoding image: {e}")
-            return {
-                'statusCode': 400,
-                'headers': {
-                    'Access-Control-Allow-Origin': '*',
-                    'Content-Type': 'application/json'
-                },
-                'body': json.dumps({'message': 'Invalid image format'})
-            }
+            return build_response(400, {'message': 'Invalid image format'})
 
-        # Index face in Rekognition
-        try:
-            rek_response = rekognition.index_faces(
-                CollectionId=COLLECTION_ID,
-                Image={'Bytes': image_bytes},
-                ExternalImageId=external_image_id,
-                DetectionAttributes=['ALL'],
-                MaxFaces=1,
-                QualityFilter="AUTO"
-            )
-        except rekognition.exceptions.ResourceNotFoundException:
-             return {
-                'statusCode': 500,
-                'headers': {
-                    'Access-Control-Allow-Origin': '*',
-                    'Content-Type': 'application/json'
-                },
-                'body': json.dumps({'message': f'Rekognition collection {COLLECTION_ID} not found'})
-            }
+        face_id = enroll(fields, external_image_id, image_bytes=image_bytes)
 
-        # Check if a face was actually indexed
-        if not rek_response['FaceRecords']:
-            return {
-                'statusCode': 400,
-                'headers': {
-                    'Access-Control-Allow-Origin': '*',
-                    'Content-Type': 'application/json'
-                },
-                'body': json.dumps({'message': 'No face detected in the image'})
-            }
+        return build_response(200, {
+            'message': 'Employee registered successfully',
+            'faceId': face_id,
+            'cedula': fields['cedula']
+        })
+
+    except RegistrationError as e:
+        body = {'message': e.message}
+        if 'Retry-After' in e.headers:
+            body['retryAfter'] = int(e.headers['Retry-After'])
+        return build_response(e.status_code, body, e.headers)
+    except Exception as e:
+        print(f"Internal Error: {str(e)}")
+        return build_response(500, {'message': f'Internal Server Error: {str(e)}'})
+
+
+@profiled
+def process_registration_upload(event, context):
+    """
+    Phase 2, triggered by S3 ObjectCreated events on uploads/: registers the
+    employee straight from the uploaded object (Rekognition S3Object input).
+
+    Throttled registrations are put back to PENDING_UPLOAD and re-raised so
+    the asynchronous invocation is retried by Lambda. On the last attempt they
+    are marked FAILED with ErrorCode 429, so the client can register again.
+    """
+    registrations = dynamodb.Table(REGISTRATIONS_TABLE)
 
-        face_id = rek_response['FaceRecords'][0]['Face']['FaceId']
-        print(f"Face indexed successfully. FaceId: {face_id}")
-
-        # Save to DynamoDB
-        table = dynamodb.Table(TABLE_NAME)
-        item = {
-            'FaceId': face_id,
-            'FirstName': first_name,
-            'LastName': last_name,
-            'Cedula': cedula,
-            'City': city,
-            'CreatedAt': str(uuid.uuid4()) # Or timestamp
+    for record in event['Records']:
+        bucket = record['s3']['bucket']['name']
+        key = unquote_plus(record['s3']['object']['key'])
+        registration_id = key[len(UPLOAD_PREFIX):].rsplit('.', 1)[0]
+
+        # Claim the registration; duplicate S3 events find it already claimed
+        try:
+            registration = registrations.update_item(
+                Key={'RegistrationId': registration_id},
+                UpdateExpression='SET #s = :processing ADD Attempts :one',
+                ConditionExpression='#s = :pending',
+                ExpressionAttributeNames={'#s': 'Status'},
+                ExpressionAttributeValues={':processing': 'PROCESSING', ':pending': 'PENDING_UPLOAD', ':one': 1},
+                ReturnValues='ALL_NEW'
+            )['Attributes']
+        except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+            print(f"Registration {registration_id} is not pending, skipping {key}")
+            continue
+
+        fields = {
+            'firstName': registration['FirstName'],
+            'lastName': registration['LastName'],
+            'cedula': registration['Cedula'],
+            'city': registration['City']
         }
+        try:
+            face_id = enroll(fields, registration['ExternalImageId'], s3_object={'Bucket': bucket, 'Name': key})
+            status, attributes = 'COMPLETED', {'FaceId': face_id, 'Message': 'Employee registered successfully'}
+        except RegistrationError as e:
+            if e.status_code == 429 and registration['Attempts'] < MAX_UPLOAD_ATTEMPTS:
+                registrations.update_item(
+                    Key={'RegistrationId': registration_id},
+                    UpdateExpression='SET #s = :pending',
+                    ExpressionAttributeNames={'#s': 'Status'},
+                    ExpressionAttributeValues={':pending': 'PENDING_UPLOAD'}
+                )
+                raise
+            status, attributes = 'FAILED', {'Message': e.message, 'ErrorCode': e.status_code}
+            if 'Retry-After' in e.headers:
+                attributes['RetryAfter'] = int(e.headers['Retry-After'])
+        except Exception as e:
+            print(f"Internal Error: {str(e)}")
+            status, attributes = 'FAILED', {'Message': f'Internal Server Error: {str(e)}', 'ErrorCode': 500}
 
-        table.put_item(Item=item)
-        print(f"Employee saved to DynamoDB: {item}")
-
-        # Publish CloudWatch Metric
-        cloudwatch_client.put_metric_data(
-            Namespace='BiometricAccessControl',
-            MetricData=[
-                {
-                    'MetricName': 'EmployeeRegistrations',
-                    'Value': 1,
-                    'Unit': 'Count'
-                },
-            ]
+        names = {'#s': 'Status'}
+        values = {':status': status}
+        assignments = ['#s = :status']
+        for i, (name, value) in enumerate(attributes.items()):
+            names[f'#a{i}'] = name
+            values[f':a{i}'] = value
+            assignments.append(f'#a{i} = :a{i}')
+        registrations.update_item(
+            Key={'RegistrationId': registration_id},
+            UpdateExpression='SET ' + ', '.join(assignments),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values
         )
+        print(f"Registration {registration_id}: {status}")
 
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Content-Type': 'application/json'
-            },
-            'body': json.dumps({
-                'message': 'Employee registered successfully',
-                'faceId': face_id,
-                'cedula': cedula
-            })
+
+def registration_status(event, context):
+    """GET /register/{registrationId}: reports the state of a two-phase registration."""
+    try:
+        registration_id = (event.get('pathParameters') or {}).get('registrationId')
+        if not registration_id:
+            return build_response(400, {'message': 'Missing registrationId'})
+
+        response = dynamodb.Table(REGISTRATIONS_TABLE).get_item(Key={'RegistrationId': registration_id})
+        if 'Item' not in response:
+            return build_response(404, {'message': f'Registration {registration_id} not found'})
+
+        registration = response['Item']
+        body = {
+            'registrationId': registration_id,
+            'status': registration['Status'],
+            'cedula': registration['Cedula']
         }
+        if 'Message' in registration:
+            body['message'] = registration['Message']
+        if 'FaceId' in registration:
+            body['faceId'] = registration['FaceId']
+        if 'ErrorCode' in registration:
+            body['errorCode'] = int(registration['ErrorCode'])
+        if 'RetryAfter' in registration:
+            body['retryAfter'] = int(registration['RetryAfter'])
+        return build_response(200, body)
 
     except Exception as e:
         print(f"Internal Error: {str(e)}")
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Content-Type': 'application/json'
-            },
-            'body': json.dumps({'message': f'Internal Server Error: {str(e)}'})
-        }
+        return build_response(500, {'message': f'Internal Server Error: {str(e)}'})
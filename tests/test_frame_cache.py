@@ -0,0 +1,56 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lambda', 'common'))
+from frame_cache import FrameCache
+
+DOOR = 'door-1'
+MATCH = ['match', 'face-of-employee-a']
+
+
+class FrameCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = FrameCache(ttl_seconds=60)
+
+    def store(self, image_bytes, result, lane=None):
+        key, cached = self.cache.get(DOOR, image_bytes, lane)
+        self.assertIsNone(cached)
+        self.cache.put(key, result)
+
+    def test_different_frames_on_same_door_never_share_a_match(self):
+        frame_a = b'\xff\xd8 employee A in front of the kiosk'
+        # Same size and background, one byte apart: still a different person
+        frame_b = b'\xff\xd8 employee B in front of the kiosk'
+        self.store(frame_a, MATCH)
+
+        _, cached = self.cache.get(DOOR, frame_b)
+        self.assertIsNone(cached)
+
+    def test_lanes_of_a_batch_never_share_a_match(self):
+        frame = b'\xff\xd8 frame'
+        self.store(frame, MATCH, lane='1')
+
+        _, cached = self.cache.get(DOOR, frame, lane='2')
+        self.assertIsNone(cached)
+        _, cached = self.cache.get('door-2', frame, lane='1')
+        self.assertIsNone(cached)
+
+    def test_identical_frame_on_same_door_and_lane_is_reused(self):
+        frame = b'\xff\xd8 frame'
+        self.store(frame, MATCH, lane='1')
+
+        _, cached = self.cache.get(DOOR, frame, lane='1')
+        self.assertEqual(cached, MATCH)
+
+    def test_disabled_cache_stores_nothing(self):
+        cache = FrameCache(ttl_seconds=0)
+        key, cached = cache.get(DOOR, b'frame')
+        self.assertIsNone(key)
+        cache.put(key, MATCH)
+        self.assertEqual(cache.get(DOOR, b'frame'), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
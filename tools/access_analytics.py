@@ -0,0 +1,192 @@
+'''
+Offline analytics over the AccessLogs and employees DynamoDB tables.
+
+Both tables are exported with parallel segmented scans into column arrays
+(NumPy .npz, or Parquet when pyarrow is installed) and every report is a
+vectorized aggregation over those columns, so a month of logs is processed
+locally in seconds instead of looping over boto3 items.
+
+Usage:
+    python -m tools.access_analytics --month 2025-01 --out build/analytics
+'''
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+import numpy as np
+
+try:
+    # Optional: Parquet export
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+DEFAULT_SEGMENTS = 8
+DEFAULT_DOOR_ID = 'default'
+
+ACCESS_LOG_COLUMNS = ('LogId', 'Timestamp', 'EmployeeId', 'EmployeeName', 'DoorId', 'Status')
+EMPLOYEE_COLUMNS = ('FaceId', 'Cedula', 'FirstName', 'LastName', 'City')
+
+
+def _scan_segment(client, table_name, columns, segment, total_segments):
+    '''Scan one segment to the end and return its items as rows of strings.'''
+    names = {'#c%d' % i: column for i, column in enumerate(columns)}
+    kwargs = {
+        'TableName': table_name,
+        'Segment': segment,
+        'TotalSegments': total_segments,
+        'ProjectionExpression': ', '.join(names),
+        'ExpressionAttributeNames': names,
+    }
+    rows = []
+    while True:
+        response = client.scan(**kwargs)
+        for item in response['Items']:
+            rows.append(tuple(item.get(column, {}).get('S', '') for column in columns))
+        if 'LastEvaluatedKey' not in response:
+            return rows
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def parallel_scan(table_name, columns, total_segments=DEFAULT_SEGMENTS):
+    '''Scan a table with one worker per segment and return {column: np.ndarray of str}.'''
+    # Low-level clients are thread-safe, resources are not
+    client = boto3.client('dynamodb')
+    with ThreadPoolExecutor(max_workers=total_segments) as pool:
+        segments = pool.map(
+            lambda segment: _scan_segment(client, table_name, columns, segment, total_segments),
+            range(total_segments)
+        )
+        rows = [row for segment_rows in segments for row in segment_rows]
+
+    if not rows:
+        return {column: np.array([], dtype=str) for column in columns}
+    matrix = np.array(rows, dtype=str)
+    return {column: matrix[:, i] for i, column in enumerate(columns)}
+
+
+def access_log_columns(raw):
+    '''Convert raw AccessLogs string columns into typed analysis columns.'''
+    return {
+        'timestamp': raw['Timestamp'].astype('datetime64[us]'),
+        'granted': raw['Status'] == 'Access Granted',
+        'employee_id': raw['EmployeeId'],
+        'employee_name': raw['EmployeeName'],
+        'door_id': np.where(raw['DoorId'] == '', DEFAULT_DOOR_ID, raw['DoorId']),
+    }
+
+
+def save_columns(columns, path):
+    '''Write columns to <path>.parquet if pyarrow is available, else <path>.npz.'''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if pyarrow is not None:
+        table = pyarrow.table({name: values for name, values in columns.items()})
+        pyarrow.parquet.write_table(table, path + '.parquet', compression='zstd')
+        return path + '.parquet'
+    np.savez_compressed(path + '.npz', **columns)
+    return path + '.npz'
+
+
+def filter_month(logs, month):
+    '''Keep only the log rows of a 'YYYY-MM' month.'''
+    start = np.datetime64(month, 'M')
+    mask = (logs['timestamp'] >= start) & (logs['timestamp'] < start + np.timedelta64(1, 'M'))
+    return {name: values[mask] for name, values in logs.items()}
+
+
+def hourly_rates(logs):
+    '''Granted/denied counts and grant rate per hour.'''
+    hours, inverse = np.unique(logs['timestamp'].astype('datetime64[h]'), return_inverse=True)
+    total = np.bincount(inverse, minlength=len(hours))
+    granted = np.bincount(inverse, weights=logs['granted'], minlength=len(hours)).astype(np.int64)
+    return {
+        'hour': hours,
+        'granted': granted,
+        'denied': total - granted,
+        'grant_rate': granted / np.maximum(total, 1),
+    }
+
+
+def first_in_last_out(logs):
+    '''First and last granted access per employee and day.'''
+    granted = {name: values[logs['granted']] for name, values in logs.items()}
+    days = granted['timestamp'].astype('datetime64[D]')
+
+    # Sort by (employee, day, timestamp) so each group is a contiguous run
+    order = np.lexsort((granted['timestamp'], days, granted['employee_id']))
+    employee_ids = granted['employee_id'][order]
+    days = days[order]
+    timestamps = granted['timestamp'][order]
+    names = granted['employee_name'][order]
+
+    boundary = np.flatnonzero((employee_ids[1:] != employee_ids[:-1]) | (days[1:] != days[:-1]))
+    if len(order) == 0:
+        starts = ends = boundary
+    else:
+        starts = np.append(0, boundary + 1)
+        ends = np.append(boundary, len(order) - 1)
+
+    return {
+        'employee_id': employee_ids[starts],
+        'employee_name': names[starts],
+        'day': days[starts],
+        'first_in': timestamps[starts],
+        'last_out': timestamps[ends],
+    }
+
+
+def deny_hotspots(logs):
+    '''Denied attempts and deny rate per door, busiest first.'''
+    doors, inverse = np.unique(logs['door_id'], return_inverse=True)
+    total = np.bincount(inverse, minlength=len(doors))
+    denied = np.bincount(inverse, weights=~logs['granted'], minlength=len(doors)).astype(np.int64)
+    order = np.argsort(-denied, kind='stable')
+    return {
+        'door_id': doors[order],
+        'denied': denied[order],
+        'attempts': total[order],
+        'deny_rate': (denied / np.maximum(total, 1))[order],
+    }
+
+
+def print_report(title, columns):
+    print('\n== %s ==' % title)
+    names = list(columns)
+    print('\t'.join(names))
+    for row in zip(*(columns[name] for name in names)):
+        print('\t'.join(
+            '%.2f' % value if isinstance(value, np.floating) else str(value) for value in row
+        ))
+
+
+def run(access_logs_table='AccessLogs', employees_table='employees', month=None,
+        out_dir='build/analytics', total_segments=DEFAULT_SEGMENTS):
+    '''Export both tables and print the compliance reports.'''
+    logs = access_log_columns(parallel_scan(access_logs_table, ACCESS_LOG_COLUMNS, total_segments))
+    employees = parallel_scan(employees_table, EMPLOYEE_COLUMNS, total_segments)
+    # Drop Cedula guard items, they carry no Cedula
+    employees = {name: values[employees['Cedula'] != ''] for name, values in employees.items()}
+
+    print('Exported %s' % save_columns(logs, os.path.join(out_dir, 'access_logs')))
+    print('Exported %s' % save_columns(employees, os.path.join(out_dir, 'employees')))
+
+    if month:
+        logs = filter_month(logs, month)
+    print('%d access log rows, %d employees' % (len(logs['timestamp']), len(employees['FaceId'])))
+
+    print_report('Hourly granted/denied', hourly_rates(logs))
+    print_report('First in / last out', first_in_last_out(logs))
+    print_report('Deny hot spots by door', deny_hotspots(logs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--access-logs-table', default='AccessLogs')
+    parser.add_argument('--employees-table', default='employees')
+    parser.add_argument('--month', help="Restrict reports to one month, e.g. 2025-01")
+    parser.add_argument('--out', default='build/analytics', help="Export directory")
+    parser.add_argument('--segments', type=int, default=DEFAULT_SEGMENTS, help="Parallel scan segments")
+    args = parser.parse_args()
+
+    run(args.access_logs_table, args.employees_table, args.month, args.out, args.segments)
@@ -0,0 +1,210 @@
+'''
+Calibration harness for the access control FaceMatchThreshold.
+
+Every labeled image is searched against the collection once, with the lowest
+threshold Rekognition accepts, and its best match is cached. Threshold sweeps
+are then vectorized over the cache, so trying new values costs no Rekognition
+calls.
+
+Dataset layout (one directory per label):
+    <dataset>/<cedula>/*.jpg   photos of an enrolled employee (label = ExternalImageId)
+    <dataset>/unknown/*.jpg    photos of people who must be denied
+
+The search goes through the same recognition backend as the Lambda functions
+(RECOGNITION_BACKEND=rekognition|local), and the search latency of uncached
+images is reported, which gives a baseline to compare both backends.
+
+Usage:
+    python -m tools.calibrate_threshold <dataset> --collection employees --max-far 0.001
+'''
+import os
+import sys
+import time
+import argparse
+import hashlib
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lambda', 'common'))
+from recognition_backend import get_retrying_backend, get_backend_name, InvalidImageError
+
+IMPOSTOR_LABEL = 'unknown'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+DEFAULT_CACHE_PATH = 'build/calibration-cache.npz'
+DEFAULT_THRESHOLDS = np.arange(50.0, 100.0, 0.5)
+# Rekognition calls per verification in access_control_handler (detect + search)
+CALLS_PER_VERIFICATION = 2
+
+
+def list_dataset(dataset_dir):
+    '''Return [(label, path)] for every image in the dataset.'''
+    samples = []
+    for label in sorted(os.listdir(dataset_dir)):
+        label_dir = os.path.join(dataset_dir, label)
+        if not os.path.isdir(label_dir):
+            continue
+        for filename in sorted(os.listdir(label_dir)):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                samples.append((label, os.path.join(label_dir, filename)))
+    return samples
+
+
+def load_cache(cache_path):
+    '''Return {'<backend>:<collection>:<image sha1>': (top_external_id, top_similarity)} from a previous run.'''
+    if not os.path.exists(cache_path):
+        return {}
+    cache = np.load(cache_path)
+    return {
+        str(digest): (str(external_id), float(similarity))
+        for digest, external_id, similarity in zip(cache['digest'], cache['external_id'], cache['similarity'])
+    }
+
+
+def save_cache(cache, cache_path):
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+    digests = list(cache)
+    np.savez_compressed(
+        cache_path,
+        digest=np.array(digests, dtype=str),
+        external_id=np.array([cache[d][0] for d in digests], dtype=str),
+        similarity=np.array([cache[d][1] for d in digests], dtype=np.float64),
+    )
+
+
+def search_best_match(backend, collection_id, image_bytes):
+    '''Best (external_id, similarity) for the image, ('', nan) if no face or no match.'''
+    try:
+        matches = backend.search_faces(image_bytes, collection_id, threshold=0, max_faces=1)
+    except InvalidImageError:
+        # No face in the image
+        return '', float('nan')
+
+    if not matches:
+        return '', float('nan')
+    return matches[0]['ExternalImageId'], matches[0]['Similarity']
+
+
+def collect_scores(samples, collection_id, cache_path=DEFAULT_CACHE_PATH):
+    '''
+    Search every uncached sample once.
+    Returns (labels, external_ids, similarities, latencies of the calls made, in seconds).
+    '''
+    cache = load_cache(cache_path)
+    backend = None
+    # Scores (and latencies) of one backend say nothing about the other
+    backend_name = get_backend_name()
+    latencies = []
+
+    labels, external_ids, similarities = [], [], []
+    try:
+        for label, path in samples:
+            with open(path, 'rb') as image_file:
+                image_bytes = image_file.read()
+            digest = '%s:%s:%s' % (backend_name, collection_id, hashlib.sha1(image_bytes).hexdigest())
+
+            if digest not in cache:
+                if backend is None:
+                    # No admission control here, so the backend retries throttling itself
+                    backend = get_retrying_backend()
+                start_t = time.perf_counter()
+                cache[digest] = search_best_match(backend, collection_id, image_bytes)
+                latencies.append(time.perf_counter() - start_t)
+
+            external_id, similarity = cache[digest]
+            labels.append(label)
+            external_ids.append(external_id)
+            similarities.append(similarity)
+    finally:
+        # Keep the scores collected so far even if a search fails, so a rerun resumes
+        if latencies:
+            save_cache(cache, cache_path)
+
+    return np.array(labels, dtype=str), np.array(external_ids, dtype=str), np.array(similarities), np.array(latencies)
+
+
+def sweep(labels, external_ids, similarities, thresholds=DEFAULT_THRESHOLDS):
+    '''
+    False-accept and false-reject rates for every threshold at once.
+
+    A sample is accepted at threshold t when its best match has similarity >= t,
+    which is what search_faces_by_image with MaxFaces=1 does in production.
+
+    Each rate has its own denominator:
+    - far: accepted impostors / impostor samples (nan without impostors)
+    - misid: employees accepted as somebody else / genuine samples
+    - frr: rejected employees / genuine samples
+    '''
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    # nan similarities (no face / no match) compare False, i.e. rejected
+    with np.errstate(invalid='ignore'):
+        accepted = similarities[np.newaxis, :] >= thresholds[:, np.newaxis]
+
+    impostor = labels == IMPOSTOR_LABEL
+    genuine = ~impostor
+    correct_identity = external_ids == labels
+
+    false_accepts = accepted & impostor[np.newaxis, :]
+    misidentified = accepted & (genuine & ~correct_identity)[np.newaxis, :]
+    false_rejects = ~accepted & genuine[np.newaxis, :]
+
+    impostor_count = int(impostor.sum())
+    genuine_count = max(int(genuine.sum()), 1)
+    return {
+        'threshold': thresholds,
+        'far': false_accepts.sum(axis=1) / impostor_count if impostor_count else np.full(len(thresholds), np.nan),
+        'misid': misidentified.sum(axis=1) / genuine_count,
+        'frr': false_rejects.sum(axis=1) / genuine_count,
+    }
+
+
+def recommend_threshold(curves, max_far):
+    '''
+    Lowest-FRR threshold whose FAR and misidentification rate are both within
+    max_far (highest threshold on ties). None without impostor samples.
+    '''
+    with np.errstate(invalid='ignore'):
+        candidates = np.flatnonzero((curves['far'] <= max_far) & (curves['misid'] <= max_far))
+    if len(candidates) == 0:
+        return None
+    best = candidates[np.flatnonzero(curves['frr'][candidates] == curves['frr'][candidates].min())[-1]]
+    return float(curves['threshold'][best])
+
+
+def run(dataset_dir, collection_id='employees', max_far=0.001, cache_path=DEFAULT_CACHE_PATH):
+    samples = list_dataset(dataset_dir)
+    labels, external_ids, similarities, latencies = collect_scores(samples, collection_id, cache_path)
+    calls_made = len(latencies)
+    curves = sweep(labels, external_ids, similarities)
+
+    print('threshold\tFAR\tMISID\tFRR')
+    for threshold, far, misid, frr in zip(curves['threshold'], curves['far'], curves['misid'], curves['frr']):
+        print('%.1f\t%.4f\t%.4f\t%.4f' % (threshold, far, misid, frr))
+
+    print('\n%d samples (%d impostors), %d search calls this run (%d cached).' % (
+        len(labels), int((labels == IMPOSTOR_LABEL).sum()), calls_made, len(labels) - calls_made))
+    if calls_made:
+        print('Search latency (%s backend): mean %.1f ms, p95 %.1f ms.' % (
+            get_backend_name(),
+            latencies.mean() * 1000, np.percentile(latencies, 95) * 1000))
+    print('Re-searching per image and threshold would take %d calls.' % (
+        len(labels) * len(curves['threshold'])))
+    print('Production cost stays at %d calls per verification for any threshold.' % CALLS_PER_VERIFICATION)
+
+    recommended = recommend_threshold(curves, max_far)
+    if not (labels == IMPOSTOR_LABEL).any():
+        print('No impostor samples in %s/%s: FAR cannot be measured.' % (dataset_dir, IMPOSTOR_LABEL))
+    elif recommended is None:
+        print('No threshold keeps FAR <= %s for collection %s.' % (max_far, collection_id))
+    else:
+        print('Recommended for collection %s: FACE_MATCH_THRESHOLD=%.1f' % (collection_id, recommended))
+    return recommended
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dataset', help="Labeled image directory")
+    parser.add_argument('--collection', default='employees', help="Rekognition collection ID")
+    parser.add_argument('--max-far', type=float, default=0.001, help="Maximum acceptable false-accept rate")
+    parser.add_argument('--cache', default=DEFAULT_CACHE_PATH, help="Similarity score cache file")
+    args = parser.parse_args()
+
+    run(args.dataset, args.collection, args.max_far, args.cache)